@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# How long the client takes to put its window up and to get connected,
+# from launch, the way a student double-clicking it sees it. Runs the
+# client (or a PyInstaller build of it, --exe) several times with
+# LESNET_STARTUP_LOG set; the first run is the cold one (as cold as the
+# OS file cache allows), the rest are reported as a median. Without
+# --server a local async_server.py is started to connect to.
+#   python bench_startup.py --runs 5 --imports 10
+#   python bench_startup.py --exe dist/client1.1.3/client1.1.3.exe --server 192.168.1.10
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(HERE, "client1.1.3.py")
+SERVER = os.path.join(HERE, os.pardir, "server_app", "async_server.py")
+RUN_TIMEOUT = 30
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server():
+    port = free_port()
+    server = subprocess.Popen([sys.executable, SERVER, "--host", "127.0.0.1", "--port", str(port), "--history", "",
+                               "--metrics-port", "0", "--no-discovery", "--log-level", "WARNING"])
+    deadline = time.monotonic() + RUN_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return server, f"127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("The local server did not come up")
+
+
+def run_client(command, address, workdir):
+    # {"window": s, "connected": s} measured from launch; missing on failure.
+    log = os.path.join(workdir, "startup.log")
+    # A throwaway home, so the runs do not add the benchmark server to the
+    # user's server list or fill their file cache.
+    env = dict(os.environ, LESNET_STARTUP_LOG=log, HOME=workdir, USERPROFILE=workdir)
+    if address:
+        env["LESNET_STARTUP_CONNECT"] = address
+    if os.path.exists(log):
+        os.remove(log)
+    started = time.time()
+    client = subprocess.Popen(command, cwd=workdir, env=env)
+    try:
+        client.wait(RUN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        client.kill()
+        client.wait()
+    times = {}
+    if os.path.exists(log):
+        with open(log, encoding="utf-8") as f:
+            for line in f:
+                event, stamp = line.split()
+                times[event] = round((float(stamp) - started) * 1000, 1)
+    return times
+
+
+def import_times(limit):
+    # Cumulative import cost of the modules the client imports itself,
+    # in ms, slowest first, from one `python -X importtime` run.
+    code = (f"import sys; sys.path.insert(0, {HERE!r}); "
+            f"exec(compile(open({CLIENT!r}, encoding='utf-8').read(), {CLIENT!r}, 'exec'), {{'__name__': 'bench'}})")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and name.startswith(" ") and not name.startswith("  "):
+            modules.append((round(int(cumulative) / 1000, 1), name.strip()))
+    modules.sort(reverse=True)
+    return modules[:limit]
+
+
+def summarize(runs, event):
+    values = [run[event] for run in runs if event in run]
+    if not values:
+        return None
+    warm = values[1:] or values
+    return {"cold_ms": values[0], "warm_median_ms": statistics.median(warm), "ok": len(values)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure time to first window and time to connected")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--exe", help="a built client instead of python client1.1.3.py")
+    parser.add_argument("--server", help="host[:port] to connect to instead of a local async_server.py")
+    parser.add_argument("--no-connect", action="store_true", help="only measure the window")
+    parser.add_argument("--imports", type=int, default=0, metavar="N", help="also list the N slowest imports")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    command = [args.exe] if args.exe else [sys.executable, CLIENT]
+    server = None
+    address = None
+    if not args.no_connect:
+        address = args.server
+        if address is None:
+            server, address = start_server()
+    results = {"command": command, "runs": []}
+    try:
+        with tempfile.TemporaryDirectory(prefix="lesnet-bench-") as workdir:
+            for _ in range(args.runs):
+                results["runs"].append(run_client(command, address, workdir))
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+    for event in ("window", "connected"):
+        summary = summarize(results["runs"], event)
+        results[event] = summary
+        if summary:
+            print(f"{event:<10} cold {summary['cold_ms']:>8.1f} ms   warm median {summary['warm_median_ms']:>8.1f} ms"
+                  f"   ({summary['ok']}/{args.runs} runs)")
+        elif event == "window" or address:
+            print(f"{event:<10} never reached (no display? wrong address?)")
+    if args.imports:
+        results["imports"] = import_times(args.imports)
+        print("slowest imports (cumulative):")
+        for ms, name in results["imports"]:
+            print(f"  {ms:>7.1f} ms  {name}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
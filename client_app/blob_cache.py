@@ -0,0 +1,94 @@
+import collections
+import os
+import shutil
+import threading
+from file_transfer import format_size
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".lesnetchat_cache")
+CACHE_BYTES = 256 * 1024 * 1024
+ID_LENGTH = 32  # hex digits of a transfer id
+
+
+class BlobCache:
+    # Files we sent or downloaded, named by transfer id (their content
+    # hash) plus the original extension so the system viewer knows what
+    # they are. Opening a file that is here never touches the network.
+    # Least recently used files go first once over max_bytes; the order
+    # survives restarts through the files' modification times.
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # id hex -> (path, size), least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with os.scandir(directory) as found:
+                files = [entry for entry in found if entry.is_file() and not entry.name.endswith(".part")
+                         and len(entry.name.partition(".")[0]) == ID_LENGTH]
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+        except OSError:
+            files = []
+        for entry in files:
+            self.entries[entry.name.partition(".")[0]] = (entry.path, entry.stat().st_size)
+            self.nbytes += entry.stat().st_size
+        self._evict()
+
+    def path_for(self, transfer_id, name):
+        return os.path.join(self.directory, transfer_id.hex() + os.path.splitext(name)[1][:16])
+
+    def get(self, transfer_id):
+        # Path of the cached file, or None; counts as a hit or a miss.
+        with self._lock:
+            entry = self.entries.get(transfer_id.hex())
+            if entry is None or not os.path.exists(entry[0]):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(transfer_id.hex())
+            self.hits += 1
+            self.bytes_saved += entry[1]
+        try:
+            os.utime(entry[0])
+        except OSError:
+            pass
+        return entry[0]
+
+    def add(self, transfer_id, path):
+        # Takes over a file already written to path_for().
+        size = os.path.getsize(path)
+        with self._lock:
+            old = self.entries.pop(transfer_id.hex(), None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.entries[transfer_id.hex()] = (path, size)
+            self.nbytes += size
+            self._evict()
+
+    def put(self, transfer_id, source):
+        # A copy of a file we are sending, unless it would crowd out too much.
+        if transfer_id.hex() in self.entries or os.path.getsize(source) > self.max_bytes // 4:
+            return
+        path = self.path_for(transfer_id, source)
+        try:
+            shutil.copyfile(source, path)
+        except OSError:
+            return
+        self.add(transfer_id, path)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, (path, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups * 100 if lookups else 0
+        return (f"cache hit rate {rate:.0f}% ({self.hits}/{lookups}), {format_size(self.bytes_saved)} not downloaded, "
+                f"{format_size(self.nbytes)} in {len(self.entries)} files")
@@ -0,0 +1,83 @@
+import collections
+import gzip
+import os
+import shutil
+import threading
+
+LOG_FILE = "client_chat.log"
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 1.0  # seconds
+
+
+class ChatLogWriter:
+    # Appends chat lines from a background thread. write() only queues the
+    # line; the writer thread flushes once flush_bytes are pending or
+    # flush_interval seconds have passed. With max_bytes set, the log is
+    # rotated to path.1 ... path.N (gzip-compressed if compress=True).
+    # close() writes out everything still queued before returning.
+    def __init__(self, path=LOG_FILE, flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 max_bytes=0, backup_count=3, compress=False):
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._lines = collections.deque()
+        self._pending_bytes = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._file = open(self.path, "a", encoding="utf-8")  # keep earlier sessions
+        self._thread = threading.Thread(target=self._run, name="chat-log", daemon=True)
+        self._thread.start()
+
+    def write(self, line):
+        with self._cond:
+            if self._closed:
+                return
+            self._lines.append(line)
+            self._pending_bytes += len(line)
+            if self._pending_bytes >= self.flush_bytes:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and self._pending_bytes < self.flush_bytes:
+                    self._cond.wait(self.flush_interval)
+                lines, self._lines = self._lines, collections.deque()
+                self._pending_bytes = 0
+                closed = self._closed
+            if lines:
+                self._file.write("".join(lines))
+                self._file.flush()
+                if self.max_bytes and self._file.tell() >= self.max_bytes:
+                    self._rotate()
+            if closed:
+                break
+        self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}{suffix}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}{suffix}")
+        if self.backup_count > 0:
+            target = f"{self.path}.1{suffix}"
+            if self.compress:
+                with open(self.path, "rb") as source, gzip.open(target, "wb") as dest:
+                    shutil.copyfileobj(source, dest)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, target)
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self, timeout=5):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
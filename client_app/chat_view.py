@@ -0,0 +1,83 @@
+import collections
+import logging
+import tkinter as tk
+from tkinter import scrolledtext
+
+# Shared by server_app and client_app; keep both copies identical.
+MAX_LINES = 1000
+FLUSH_INTERVAL_MS = 33
+MAX_EVENTS_PER_TICK = 200
+
+log = logging.getLogger("lesnet.ui")
+
+
+class UiQueue:
+    # The only way network threads touch Tk. post() just appends to a deque
+    # and never blocks; pump() runs on the Tk main loop via after(), runs at
+    # most max_per_tick callbacks, then flushes the message views once. With
+    # a backlog it comes back after 1 ms instead of a full interval, so input
+    # and redraw events still get a turn between batches.
+    def __init__(self, master, interval=FLUSH_INTERVAL_MS, max_per_tick=MAX_EVENTS_PER_TICK):
+        self.master = master
+        self.interval = interval
+        self.max_per_tick = max_per_tick
+        self.views = []
+        self._events = collections.deque()
+        self.master.after(self.interval, self.pump)
+
+    def post(self, callback, *args):
+        self._events.append((callback, args))
+
+    def __len__(self):
+        return len(self._events)
+
+    def pump(self):
+        for _ in range(min(len(self._events), self.max_per_tick)):
+            callback, args = self._events.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("UI callback %r failed", callback)
+        for view in self.views:
+            view.flush()
+        self.master.after(1 if self._events else self.interval, self.pump)
+
+
+class MessageView(scrolledtext.ScrolledText):
+    # ScrolledText with a bounded scrollback, used from the Tk thread only
+    # (network threads go through UiQueue.post). append() only queues the
+    # line; flush() inserts everything queued with one insert() call once per
+    # UiQueue tick, then trims the oldest lines so the widget never holds more
+    # than max_lines. Without a UiQueue it runs its own flush timer.
+    def __init__(self, master=None, ui=None, max_lines=MAX_LINES, flush_interval=FLUSH_INTERVAL_MS, **options):
+        super().__init__(master, **options)
+        self.max_lines = max_lines
+        self.flush_interval = flush_interval
+        # A burst bigger than the scrollback would be trimmed anyway, so only
+        # the newest max_lines are ever kept pending.
+        self._pending = collections.deque(maxlen=max_lines)
+        if ui is not None:
+            ui.views.append(self)
+        else:
+            self.after(self.flush_interval, self._tick)
+
+    def append(self, message, tag=None):
+        self._pending.append((message + "\n", tag or ()))
+
+    def _tick(self):
+        self.flush()
+        self.after(self.flush_interval, self._tick)
+
+    def flush(self):
+        if not self._pending:
+            return
+        chunks = []
+        while self._pending:
+            chunks.extend(self._pending.popleft())
+        follow = self.yview()[1] >= 1.0  # only autoscroll if already at the bottom
+        self.insert(tk.END, *chunks)
+        excess = int(self.index("end-1c").split(".")[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.delete("1.0", f"{excess + 1}.0")
+        if follow:
+            self.yview(tk.END)
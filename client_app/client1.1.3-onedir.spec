@@ -0,0 +1,53 @@
+# -*- mode: python ; coding: utf-8 -*-
+# Unpacked ("one-dir") build: dist/client1.1.3/client1.1.3.exe next to its libraries.
+# It starts much faster than the one-file client1.1.3.spec build, which unpacks
+# itself into a temp directory on every launch; no UPX either, since
+# decompressing the DLLs costs more at startup than it saves on disk.
+# The games run inside the client (game_host.py): their modules and card
+# images are bundled, PIL is not needed since Tk decodes the PNGs itself.
+import os
+
+GAME_DIR = 'playingcard-mini/playingcard-mini'
+
+
+a = Analysis(
+    ['client1.1.3.py'],
+    pathex=[os.path.join(SPECPATH, GAME_DIR)],
+    binaries=[],
+    datas=[(os.path.join(GAME_DIR, '*.png'), GAME_DIR)],
+    hiddenimports=['brackjack', 'slot'],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=['unittest', 'pydoc', 'doctest', 'PIL'],
+    noarchive=False,
+    optimize=0,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='client1.1.3',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='client1.1.3',
+)
@@ -1,14 +1,84 @@
+import collections
 import socket
 import threading
 import tkinter as tk
-from tkinter import scrolledtext, messagebox
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-import subprocess
+from tkinter import filedialog, messagebox, ttk
+import shutil
 import os
+import random
+import time
+from blob_cache import BlobCache
+from chat_log import ChatLogWriter
+from chat_view import MessageView, UiQueue
+from discovery import ServerCache
+from file_transfer import Download, Upload, format_size, hash_file, open_file
+from game_host import GameHost
+from ordering import ReorderBuffer
+from protocol import (FrameDecoder, encode_frame, unpack_history, channel_id, MSG_HELLO, MSG_CHAT, MSG_WELCOME, MSG_HISTORY,
+                      MSG_HISTORY_REQUEST, MSG_RESUME, MSG_PING, MSG_PONG, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE, MSG_CHANNEL_CHAT,
+                      MSG_CHANNEL_HISTORY, MSG_UPLOAD, MSG_UPLOAD_CHUNK, MSG_DOWNLOAD, MSG_FILE_CHUNK, MSG_TRANSFER_ACK,
+                      SERVER_HELLO, WELCOME, HISTORY_REQUEST, RESUME, CHAT_HEADER, NOTICE_SEQ, CHANNEL, SUBSCRIBE, TRANSFER,
+                      CHUNK, CREDIT, LOBBY, LOBBY_ID, MAX_CHANNEL_NAME, CHUNK_SIZE, MAX_FILE_SIZE, FILE_LINK, RECV_SIZE,
+                      file_link)
+from payload_codec import CodecError, decode_payload, encode_payload, supported, CODEC_ZLIB
 
 BROADCAST_PORT = 5555
-BUFFER_SIZE = 1024
+BUFFER_SIZE = RECV_SIZE
+HANDSHAKE_TIMEOUT = 10
+LOG_FILE = "client_chat.log"
+LOG_MAX_BYTES = 1024 * 1024  # rotate after 1 MiB
+LOG_BACKUPS = 5
+LOG_COMPRESS = True
+RECONNECT_BASE = 0.05  # first retry within 50 ms, doubling up to RECONNECT_MAX
+RECONNECT_MAX = 10.0
+RECONNECT_ATTEMPTS = 30
+UPLINK_CODEC = CODEC_ZLIB  # every server that negotiates compression can decode zlib
+SERVER_TIMEOUT = 50  # the server pings us after 15 s of quiet, so this much silence means it is gone
+UNCONFIRMED_LINES = 64  # own lines remembered until their echo; throttled ones never come back
+STARTUP_LOG = os.environ.get("LESNET_STARTUP_LOG")  # set by bench_startup.py
+session_crypto = None  # see load_crypto()
+
+
+def backoff_delays():
+    # "Full jitter": a random delay up to the exponential cap, so a whole
+    # classroom dropped by the same Wi-Fi hiccup does not reconnect in lockstep.
+    for attempt in range(RECONNECT_ATTEMPTS):
+        yield random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt))
+
+def load_crypto():
+    # cryptography is by far the slowest import, so the window comes up
+    # without it and the first connect pays for it instead.
+    global session_crypto
+    if session_crypto is None:
+        import session_crypto
+
+def log_startup(event):
+    # Appends "<event> <unix time>" to STARTUP_LOG; a windowed build has no stdout.
+    with open(STARTUP_LOG, "a", encoding="utf-8") as f:
+        f.write(f"{event} {time.time():.6f}\n")
+
+def probe_startup(root, client):
+    # For bench_startup.py: note when the window is up and, given
+    # LESNET_STARTUP_CONNECT=host[:port], when we are connected, then quit.
+    def mapped(event):
+        if event.widget is root:
+            root.unbind("<Map>")
+            root.after_idle(finish)  # once it has been drawn
+
+    def finish():
+        log_startup("window")
+        address = os.environ.get("LESNET_STARTUP_CONNECT")
+        if address:
+            client.server_ip.set(address)
+            client.connect_to_server()
+            log_startup("connected" if hasattr(client, "client_id") else "failed")
+        client.closing = True
+        if hasattr(client, "client_socket"):
+            client.client_socket.close()
+        client.log_file.close()
+        root.destroy()
+
+    root.bind("<Map>", mapped)
 
 class ChatClient:
     def __init__(self, master):
@@ -20,6 +90,9 @@ class ChatClient:
 
         self.server_ip = tk.StringVar()
         self.server_ip.set("Enter server IP address")
+        self.servers = ServerCache()  # servers we found or connected to before, newest first
+        if self.servers.servers:
+            self.server_ip.set(self.format_address(*self.servers.servers[0][:2]))
 
         self.nickname_label = tk.Label(master, text="Nickname:")
         self.nickname_label.pack()
@@ -33,14 +106,36 @@ class ChatClient:
 
         self.connect_button = tk.Button(master, text="Connect", command=self.connect_to_server)
         self.connect_button.pack()
+        self.discover_button = tk.Button(master, text="Find Servers", command=self.discover_servers)
+        self.discover_button.pack()
+
+        self.ui = UiQueue(master)  # the receive thread hands UI work to the Tk loop through this
+
+        # Rooms: type a name (or pick one you are in) and press Enter to chat
+        # there; lines from your other rooms are shown with the room name.
+        self.room = LOBBY
+        self.room_name = tk.StringVar(value=LOBBY)
+        self.room_label = tk.Label(master, text="Room:")
+        self.room_label.pack()
+        self.room_box = ttk.Combobox(master, textvariable=self.room_name, values=[LOBBY])
+        self.room_box.bind("<<ComboboxSelected>>", self.switch_room)
+        self.room_box.bind("<Return>", self.switch_room)
+        self.room_box.pack()
+        self.leave_button = tk.Button(master, text="Leave Room", command=self.leave_room)
+        self.leave_button.pack()
 
         self.messages_frame = tk.Frame(master)
         self.my_msg = tk.StringVar()  # For the messages to be sent.
         self.my_msg.set("Type your messages here.")
 
         scrollbar = tk.Scrollbar(self.messages_frame)  # To see through previous messages.
-        self.msg_list = scrolledtext.ScrolledText(self.messages_frame, height=15, width=50, yscrollcommand=scrollbar.set, wrap=tk.WORD)
+        self.msg_list = MessageView(self.messages_frame, ui=self.ui, height=15, width=50, yscrollcommand=scrollbar.set, wrap=tk.WORD)
         self.msg_list.tag_config("self", foreground="red")
+        self.msg_list.tag_config("history", foreground="gray")
+        self.msg_list.tag_config("file", foreground="blue", underline=True)  # click to open, right-click to save
+        self.msg_list.tag_bind("file", "<Button-1>", self.download_file)
+        self.msg_list.tag_bind("file", "<Button-3>", lambda event: self.download_file(event, save=True))
+        self.cache = BlobCache()  # files we sent or opened before, by content hash
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.msg_list.pack(side=tk.LEFT, fill=tk.BOTH)
         self.msg_list.pack()
@@ -51,6 +146,8 @@ class ChatClient:
         self.entry_field.pack()
         self.send_button = tk.Button(master, text="Send", command=self.send)
         self.send_button.pack()
+        self.file_button = tk.Button(master, text="Send File", command=self.send_file)
+        self.file_button.pack()
 
         # Adding version label
         self.version_label = tk.Label(master, text="Version 1.1.3", font=("Arial", 10))
@@ -59,19 +156,33 @@ class ChatClient:
         # Adding Play Game button
         self.play_game_button = tk.Button(master, text="Play Game", command=self.open_game_selection)
         self.play_game_button.pack(side=tk.LEFT, anchor="sw", padx=10, pady=10)
+        self.games = GameHost(master)  # games open as windows of this client
 
-        # Create or open chat log file
-        self.log_file = open("client_chat.log", "w")
+        # Chat log is appended across sessions by a background writer
+        self.log_file = ChatLogWriter(LOG_FILE, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUPS,
+                                      compress=LOG_COMPRESS)
 
     def connect_to_server(self):
         server_ip = self.server_ip.get()
         if server_ip and server_ip != "Enter server IP address":
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            host, _, port = server_ip.strip().partition(":")
+            port = int(port) if port.isdigit() else BROADCAST_PORT
+            self.server_address = (host, port)
+            self.ticket = None
+            self.closing = False
+            self.rooms = {LOBBY_ID: LOBBY}  # channel id -> name of every room we are in
+            self.orderings = {LOBBY_ID: ReorderBuffer()}  # every room has its own sequence numbers
+            self.show_room(LOBBY)
+            # (channel, line) we sent and showed already, until the server echoes them in order
+            self.unconfirmed = collections.deque(maxlen=UNCONFIRMED_LINES)
+            self.send_lock = threading.Lock()
+            self.chat_waiting = 0  # chat lines waiting for send_lock; file chunks give way to them
+            self.uploads = {}    # transfer id -> Upload
+            self.downloads = {}  # transfer id -> Download
             try:
-                self.client_socket.connect((server_ip, BROADCAST_PORT))
-                self.key = self.client_socket.recv(32)
-                self.iv = self.client_socket.recv(16)
-                self.receive_thread = threading.Thread(target=self.receive)
+                self.open_session()
+                self.servers.remember(host, port)
+                self.receive_thread = threading.Thread(target=self.receive, args=(self.pending_frames,))
                 self.receive_thread.daemon = True
                 self.receive_thread.start()
             except Exception as e:
@@ -81,55 +192,462 @@ class ChatClient:
         else:
             messagebox.showerror("Input Error", "Please enter a valid server IP address.")
 
-    def encrypt(self, plaintext):
-        encryptor = Cipher(
-            algorithms.AES(self.key),
-            modes.CFB(self.iv),
-            backend=default_backend()
-        ).encryptor()
-        return encryptor.update(plaintext.encode('utf-8')) + encryptor.finalize()
-
-    def decrypt(self, ciphertext):
-        decryptor = Cipher(
-            algorithms.AES(self.key),
-            modes.CFB(self.iv),
-            backend=default_backend()
-        ).decryptor()
-        return decryptor.update(ciphertext) + decryptor.finalize()
-
-    def receive(self):
+    def format_address(self, ip, port):
+        return ip if port == BROADCAST_PORT else f"{ip}:{port}"
+
+    def discover_servers(self):
+        # Cached servers are asked first by unicast, then the whole LAN.
+        self.discover_button.config(state=tk.DISABLED)
+        threading.Thread(target=lambda: self.ui.post(self.show_servers, self.servers.lookup()), daemon=True).start()
+
+    def show_servers(self, found):
+        self.discover_button.config(state=tk.NORMAL)
+        if not found:
+            self.msg_list.append("No servers found on this network.", "history")
+            return
+        for ip, port, name in found:
+            self.servers.remember(ip, port, name)
+            self.msg_list.append(f"Found server {name} at {self.format_address(ip, port)}", "history")
+        self.server_ip.set(self.format_address(*found[0][:2]))
+
+    def open_session(self):
+        # TCP connect, then either resume with the ticket from the last
+        # WELCOME or do the full X25519 key exchange for a new uplink key.
+        # Either way the server answers with WELCOME: our id, the shared
+        # broadcast key and a fresh ticket.
+        load_crypto()
+        self.client_socket = socket.create_connection(self.server_address, HANDSHAKE_TIMEOUT)
+        self.decoder = FrameDecoder()
+        self.pending_frames = []
+        hello = self.wait_for_frame(MSG_HELLO)
+        algorithm, = SERVER_HELLO.unpack_from(hello)
+        resuming = self.ticket is not None
+        if resuming:
+            nonce = os.urandom(session_crypto.RESUME_NONCE_SIZE)
+            lobby = self.orderings.get(LOBBY_ID)
+            self.client_socket.sendall(encode_frame(MSG_RESUME, RESUME.pack(lobby and lobby.last_seq or 0, nonce)
+                                                    + self.ticket))
+        else:
+            exchange = session_crypto.KeyExchange()
+            # Listing the codecs we can decode turns payload compression on.
+            self.client_socket.sendall(encode_frame(MSG_HELLO, exchange.public_bytes + supported()))
+            self.uplink = session_crypto.SessionCipher(exchange.derive(hello[SERVER_HELLO.size:]), algorithm)
+        try:
+            frame = self.wait_for_frame(MSG_WELCOME)
+        except ConnectionError:
+            if resuming:
+                self.ticket = None  # refused (server restarted?), do the full handshake next time
+            raise
+        if resuming:
+            # The server's half of the new uplink key comes in front of WELCOME.
+            server_nonce, frame = frame[:session_crypto.RESUME_NONCE_SIZE], frame[session_crypto.RESUME_NONCE_SIZE:]
+            self.uplink = session_crypto.SessionCipher(
+                session_crypto.resume_key(self.uplink.key, nonce, server_nonce), algorithm)
+        welcome = self.uplink.decrypt(frame)
+        self.client_id, = WELCOME.unpack_from(welcome)
+        key_end = WELCOME.size + session_crypto.KEY_SIZE
+        self.group = session_crypto.SessionCipher(welcome[WELCOME.size:key_end], algorithm)
+        self.ticket = welcome[key_end:] or None
+        if not resuming:
+            # A new session numbers from the server's replays, and will not
+            # echo lines the old one never got to.
+            self.orderings = {channel: ReorderBuffer() for channel in self.rooms}
+            self.unconfirmed.clear()
+        # The server puts us in the lobby; the other rooms are up to us.
+        for channel, name in list(self.rooms.items()):
+            if channel != LOBBY_ID:
+                after = self.orderings[channel].last_seq or 0
+                self.client_socket.sendall(encode_frame(MSG_SUBSCRIBE, SUBSCRIBE.pack(after) + name.encode('utf-8')))
+        if LOBBY_ID not in self.rooms:
+            self.client_socket.sendall(encode_frame(MSG_UNSUBSCRIBE, LOBBY.encode('utf-8')))
+        # Transfers go on where the server (or we) got to.
+        for upload in list(self.uploads.values()):
+            upload.restart()
+            self.client_socket.sendall(encode_frame(MSG_UPLOAD, TRANSFER.pack(upload.id, upload.size, upload.token)))
+        for download in list(self.downloads.values()):
+            self.client_socket.sendall(encode_frame(MSG_DOWNLOAD, CREDIT.pack(download.id, download.offset,
+                                                                            download.restart())))
+        self.client_socket.settimeout(None)
+
+    def wait_for_frame(self, msg_type):
+        while True:
+            while self.pending_frames:
+                frame_type, payload = self.pending_frames.pop(0)
+                if frame_type == msg_type:
+                    return payload
+            frames = self.decoder.recv_from(self.client_socket, BUFFER_SIZE)
+            if frames is None:
+                raise ConnectionError("Server closed the connection")
+            self.pending_frames.extend(frames)
+
+    def encrypt(self, plaintext, aad=None):
+        return self.uplink.encrypt(encode_payload(UPLINK_CODEC, plaintext.encode('utf-8')), aad)
+
+    def decrypt(self, ciphertext, header=None):
+        return decode_payload(UPLINK_CODEC, self.group.decrypt(ciphertext, header))
+
+    def receive(self, frames=()):
+        # Reconnect supervisor around receive_frames().
+        while True:
+            self.receive_frames(frames)
+            if self.closing or not self.reconnect():
+                break
+            frames = self.pending_frames
+
+    def reconnect(self):
+        self.client_socket.close()
+        self.ui.post(self.display_message, "Connection lost, reconnecting...", "history")
+        for delay in backoff_delays():
+            time.sleep(delay)
+            if self.closing:
+                return False
+            try:
+                started = time.perf_counter()
+                self.open_session()
+            except (OSError, ValueError, session_crypto.InvalidTag):
+                continue
+            self.ui.post(self.display_message,
+                         f"Reconnected in {(time.perf_counter() - started) * 1000:.0f} ms", "history")
+            return True
+        self.ui.post(self.display_message, "Could not reconnect. Press Connect to try again.", "history")
+        return False
+
+    def receive_frames(self, frames=()):
+        timeout = None
+        last_heard = time.monotonic()
         while True:
             try:
-                encrypted_message = self.client_socket.recv(BUFFER_SIZE)
-                if not encrypted_message:
+                for msg_type, payload in frames:
+                    try:
+                        if msg_type == MSG_CHAT:
+                            self.receive_chat(payload)
+                        elif msg_type == MSG_HISTORY:
+                            self.receive_history(unpack_history(self.decrypt(payload)))
+                        elif msg_type == MSG_CHANNEL_CHAT:
+                            channel, = CHANNEL.unpack_from(payload)
+                            self.receive_chat(payload, channel, CHANNEL.size)
+                        elif msg_type == MSG_CHANNEL_HISTORY:
+                            channel, = CHANNEL.unpack_from(payload)
+                            prefix = payload[:CHANNEL.size]
+                            self.receive_history(unpack_history(self.decrypt(payload[CHANNEL.size:], prefix)), channel)
+                        elif msg_type == MSG_FILE_CHUNK:
+                            self.receive_file_chunk(payload)
+                        elif msg_type == MSG_TRANSFER_ACK:
+                            self.receive_transfer_ack(*CREDIT.unpack(payload))
+                        elif msg_type == MSG_PING:
+                            with self.send_lock:
+                                self.client_socket.sendall(encode_frame(MSG_PONG, payload))
+                    except (session_crypto.InvalidTag, UnicodeDecodeError, CodecError):
+                        continue  # corrupted or forged, skip it
+                wanted = self.expire_gaps()  # wake up to give up on a gap
+                if wanted is None:
+                    wanted = SERVER_TIMEOUT
+                if wanted != timeout:
+                    timeout = wanted
+                    self.client_socket.settimeout(timeout)
+                frames = self.decoder.recv_from(self.client_socket, BUFFER_SIZE)
+                if frames is None:
                     break
-                message = self.decrypt(encrypted_message).decode('utf-8')
-                self.display_message(message)
+                last_heard = time.monotonic()
+            except socket.timeout:
+                if time.monotonic() - last_heard >= SERVER_TIMEOUT:
+                    break  # dead server or network, let the supervisor reconnect
+                frames = ()
             except OSError:
                 break
 
+    def expire_gaps(self):
+        # Returns the seconds until the next gap in any room times out.
+        wanted = None
+        for channel, ordering in list(self.orderings.items()):
+            skipped = ordering.skipped
+            self.deliver(ordering.expire(), channel)
+            if ordering.skipped != skipped:
+                self.ui.post(self.display_message,
+                             f"({ordering.skipped - skipped} messages could not be recovered)", "history")
+            timeout = ordering.timeout()
+            if timeout is not None and (wanted is None or timeout < wanted):
+                wanted = timeout
+        return wanted
+
+    def receive_chat(self, payload, channel=LOBBY_ID, offset=0):
+        # `offset` skips the CHANNEL prefix, which is authenticated with the header.
+        header = payload[:offset + CHAT_HEADER.size]
+        seq, ts, origin = CHAT_HEADER.unpack_from(header, offset)
+        message = self.decrypt(payload[len(header):], header).decode('utf-8')
+        if seq == NOTICE_SEQ:
+            self.ui.post(self.display_message, message)
+            return
+        ordering = self.orderings.get(channel)
+        if ordering is None:
+            return  # a room we just left
+        ready, missing = ordering.push([(seq, ts, message, origin)])
+        self.deliver(ready, channel)
+        self.request_missing(missing, channel)
+
+    def receive_history(self, records, channel=LOBBY_ID):
+        ordering = self.orderings.get(channel)
+        if ordering is None:
+            return
+        joining = ordering.last_seq is None
+        ready, missing = ordering.push([(seq, ts, message, None) for seq, ts, message in records])
+        if joining:
+            self.ui.post(self.display_history, ready, self.room_prefix(channel))
+        else:
+            self.deliver(ready, channel)  # fills a gap
+        self.request_missing(missing, channel)
+
+    def deliver(self, records, channel=LOBBY_ID):
+        prefix = self.room_prefix(channel)
+        for seq, ts, message, origin in records:
+            if origin == self.client_id or (origin is None and (channel, message) in self.unconfirmed):
+                self.confirm(channel, message)
+                continue  # our own line, already on screen
+            self.ui.post(self.display_message, prefix + message)
+
+    def confirm(self, channel, message):
+        # Our line came back. The server handles our lines in order, so any
+        # we sent to that room before it and have not seen were dropped
+        # (throttled) and will not come back either.
+        entry = (channel, message)
+        pending = list(self.unconfirmed)
+        if entry not in pending:
+            return
+        for sent in pending[:pending.index(entry) + 1]:
+            if sent[0] == channel:
+                try:
+                    self.unconfirmed.remove(sent)
+                except ValueError:
+                    pass
+
+    def room_prefix(self, channel):
+        # Lines from the room we are chatting in are shown as they are.
+        if channel == channel_id(self.room):
+            return ""
+        return f"[{self.rooms.get(channel, '?')}] "
+
+    def request_missing(self, missing, channel=LOBBY_ID):
+        if missing:
+            request = HISTORY_REQUEST.pack(*missing) + (CHANNEL.pack(channel) if channel != LOBBY_ID else b"")
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_HISTORY_REQUEST, request))
+
+    def switch_room(self, event=None):
+        if not hasattr(self, 'client_socket'):
+            return
+        name = self.room_name.get().strip() or LOBBY
+        if len(name.encode('utf-8')) > MAX_CHANNEL_NAME:
+            messagebox.showerror("Room Error", f"Room names can be at most {MAX_CHANNEL_NAME} bytes long.")
+            return
+        channel = channel_id(name)
+        joining = channel not in self.rooms
+        if joining:
+            self.rooms[channel] = name
+            self.orderings[channel] = ReorderBuffer()
+        self.show_room(name)
+        self.display_message(f"Now chatting in {name}", "history")
+        if joining:
+            # Same connection; the server answers with the room's replay.
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_SUBSCRIBE, SUBSCRIBE.pack(0) + name.encode('utf-8')))
+
+    def leave_room(self):
+        if not hasattr(self, 'client_socket') or len(self.rooms) == 1:
+            return  # always stay in at least one room
+        channel = channel_id(self.room)
+        with self.send_lock:
+            self.client_socket.sendall(encode_frame(MSG_UNSUBSCRIBE, self.room.encode('utf-8')))
+        self.rooms.pop(channel, None)
+        self.orderings.pop(channel, None)
+        self.display_message(f"Left {self.room}", "history")
+        self.show_room(self.rooms.get(LOBBY_ID) or next(iter(self.rooms.values())))
+
+    def show_room(self, name):
+        self.room = name
+        self.room_name.set(name)
+        self.room_box.config(values=list(self.rooms.values()))
+
     def send(self, event=None):
         if not hasattr(self, 'client_socket'):
             return
         msg = self.my_msg.get()
         self.my_msg.set("")  # Clears input field.
+        self.send_message(msg)
+
+    def send_message(self, msg, room=None):
         nickname = self.nickname.get()
         full_msg = f"{nickname}: {msg}"
-        encrypted_message = self.encrypt(full_msg)
+        channel = channel_id(room or self.room)
         try:
-            self.client_socket.send(encrypted_message)
+            self.unconfirmed.append((channel, full_msg))  # before sending, the echo can beat us back
+            if channel == LOBBY_ID:
+                frame = encode_frame(MSG_CHAT, self.encrypt(full_msg))
+            else:
+                prefix = CHANNEL.pack(channel)
+                frame = encode_frame(MSG_CHANNEL_CHAT, prefix + self.encrypt(full_msg, prefix))
+            self.chat_waiting += 1
+            try:
+                with self.send_lock:
+                    self.client_socket.sendall(frame)
+            finally:
+                self.chat_waiting -= 1
             self.display_message(full_msg, "self")
             if msg == "{quit}":
+                self.closing = True
                 self.client_socket.close()
                 self.master.quit()
         except Exception as e:
             messagebox.showerror("Send Error", f"Unable to send the message: {e}")
 
     def display_message(self, message, tag=None):
-        self.msg_list.insert(tk.END, message + "\n", tag)
-        self.msg_list.yview(tk.END)
+        if FILE_LINK.search(message):
+            tag = (tag, "file") if tag else "file"
+        self.msg_list.append(message, tag)
         self.log_file.write(message + "\n")
-        self.log_file.flush()
+
+    def display_history(self, records, prefix=""):
+        # Replayed messages from before we joined; shown greyed out, not logged again.
+        for seq, ts, message, _ in records:
+            tag = ("history", "file") if FILE_LINK.search(message) else "history"
+            self.msg_list.append(f"[{time.strftime('%H:%M', time.localtime(ts))}] {prefix}{message}", tag)
+
+    def send_file(self):
+        # Files (images included) go over the same connection in encrypted
+        # chunks, paced by the server's credit, and are announced in the
+        # current room once the server has all of them.
+        if not hasattr(self, 'client_socket'):
+            return
+        path = filedialog.askopenfilename(title="Send File")
+        if not path:
+            return
+        size = os.path.getsize(path)
+        if not 0 < size <= MAX_FILE_SIZE:
+            messagebox.showerror("File Error", f"Files can be 1 byte to {format_size(MAX_FILE_SIZE)}.")
+            return
+        self.display_message(f"Sending {os.path.basename(path)} ({format_size(size)})...", "history")
+        threading.Thread(target=self.upload_file, args=(path, self.room), daemon=True).start()
+
+    def upload_file(self, path, room):
+        # Upload thread: hash the file, offer it, then one chunk per credit
+        # step, read from disk as it goes. The server answers an offer for a
+        # file it already has with "all done", so nothing is sent.
+        try:
+            upload = Upload(path, hash_file(path))
+        except OSError as e:
+            self.ui.post(self.display_message, f"Could not read {os.path.basename(path)}: {e}", "history")
+            return
+        self.cache.put(upload.id, path)
+        self.uploads[upload.id] = upload
+        try:
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_UPLOAD, TRANSFER.pack(upload.id, upload.size,
+                                                                                upload.token)))
+        except OSError:
+            pass  # the reconnect offers it again
+        with open(upload.path, "rb") as f:
+            while True:
+                offset = upload.next_offset()
+                if offset is None:
+                    break
+                f.seek(offset)
+                chunk = f.read(CHUNK_SIZE)
+                header = CHUNK.pack(upload.id, offset)
+                try:
+                    self.send_bulk(encode_frame(MSG_UPLOAD_CHUNK, header + self.uplink.encrypt(chunk, header)))
+                except OSError:
+                    time.sleep(1)  # the receive thread reconnects and restarts the upload
+                    continue
+                upload.sent(offset, len(chunk))
+        ok = upload.finished()
+        self.uploads.pop(upload.id, None)
+        if not ok:
+            self.ui.post(self.display_message, f"Could not send {upload.name}.", "history")
+            return
+        if upload.deduplicated:
+            self.ui.post(self.display_message, f"{upload.name} was already on the server, nothing to send.", "history")
+        line = f"[file] {upload.name} ({format_size(upload.size)}) {file_link(upload.id, upload.size)}"
+        self.ui.post(self.send_message, line, room)  # announced where the upload was started
+
+    def send_bulk(self, frame):
+        # File chunks wait while a chat line wants the socket, so a big
+        # upload delays a message by one chunk at most.
+        while self.chat_waiting:
+            time.sleep(0.001)
+        with self.send_lock:
+            self.client_socket.sendall(frame)
+
+    def download_file(self, event, save=False):
+        # Click: open the file; right-click: save a copy. Either way it is
+        # fetched into the cache first, unless it is there already.
+        line = self.msg_list.get(f"@{event.x},{event.y} linestart", f"@{event.x},{event.y} lineend")
+        match = FILE_LINK.search(line)
+        if match is None:
+            return
+        transfer_id, size = bytes.fromhex(match.group(1)), int(match.group(2))
+        if transfer_id in self.downloads:
+            return
+        name = os.path.basename(line[:match.start()].rpartition("[file] ")[2].rpartition(" (")[0])
+        save_as = None
+        if save:
+            save_as = filedialog.asksaveasfilename(title="Save File", initialfile=name)
+            if not save_as:
+                return
+        cached = self.cache.get(transfer_id)
+        if cached is not None:
+            self.display_message(f"{name} from the cache: {self.cache.summary()}", "history")
+            self.use_file(cached, save_as)
+            return
+        if not hasattr(self, 'client_socket'):
+            return
+        try:
+            download = Download(transfer_id, size, self.cache.path_for(transfer_id, name), save_as)
+        except OSError as e:
+            messagebox.showerror("File Error", f"Cannot save the file: {e}")
+            return
+        self.downloads[transfer_id] = download
+        self.display_message(f"Downloading {name} ({format_size(size)})...", "history")
+        with self.send_lock:
+            self.client_socket.sendall(encode_frame(MSG_DOWNLOAD, CREDIT.pack(transfer_id, 0, download.limit)))
+
+    def receive_file_chunk(self, payload):
+        header = payload[:CHUNK.size]
+        transfer_id, offset = CHUNK.unpack(header)
+        download = self.downloads.get(transfer_id)
+        if download is None:
+            return
+        try:
+            done = download.write(offset, self.group.decrypt(payload[CHUNK.size:], header))
+        except (OSError, ValueError) as e:
+            self.downloads.pop(transfer_id).cancel()
+            self.ui.post(self.display_message, f"Download failed: {e}", "history")
+            return
+        if done:
+            self.downloads.pop(transfer_id)
+            self.cache.add(transfer_id, download.path)
+            self.ui.post(self.use_file, download.path, download.save_as)
+            return
+        limit = download.credit()
+        if limit is not None:
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_TRANSFER_ACK, CREDIT.pack(transfer_id, download.offset,
+                                                                                    limit)))
+
+    def use_file(self, path, save_as=None):
+        try:
+            if save_as:
+                shutil.copyfile(path, save_as)
+                self.display_message(f"Saved {save_as}", "history")
+            else:
+                open_file(path)
+        except OSError as e:
+            self.display_message(f"Cannot open {path}: {e}", "history")
+
+    def receive_transfer_ack(self, transfer_id, offset, limit):
+        upload = self.uploads.get(transfer_id)
+        if upload is not None:
+            upload.ack(offset, limit)
+        elif not limit and transfer_id in self.downloads:
+            self.downloads.pop(transfer_id).cancel()  # refused, the notice says why
 
     def on_closing(self, event=None):
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
@@ -141,8 +659,7 @@ class ChatClient:
             except Exception as e:
                 print(f"Error closing the connection: {e}")
             finally:
-                self.log_file.close()
-                os.remove("client_chat.log")
+                self.log_file.close()  # drains whatever is still queued
                 self.master.destroy()
 
     def open_game_selection(self):
@@ -157,17 +674,22 @@ class ChatClient:
         slot_button.pack(pady=10)
 
     def start_blackjack(self):
-        script_path = os.path.join(os.path.dirname(__file__), 'playingcard-mini', 'playingcard-mini', 'brackjack.py')
-        subprocess.Popen(['python', script_path])
-        self.game_window.destroy()
+        self.start_game("blackjack")
 
     def start_slot(self):
-        script_path = os.path.join(os.path.dirname(__file__), 'playingcard-mini', 'playingcard-mini', 'slot.py')
-        subprocess.Popen(['python', script_path])
+        self.start_game("slot")
+
+    def start_game(self, name):
         self.game_window.destroy()
+        try:
+            self.games.open(name)
+        except Exception as e:
+            messagebox.showerror("Game Error", f"Unable to start the game: {e}")
 
 if __name__ == "__main__":
     root = tk.Tk()
     client = ChatClient(root)
     root.protocol("WM_DELETE_WINDOW", client.on_closing)
+    if STARTUP_LOG:
+        probe_startup(root, client)
     root.mainloop()
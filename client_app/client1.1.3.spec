@@ -1,16 +1,21 @@
 # -*- mode: python ; coding: utf-8 -*-
+# The games run inside the client (game_host.py): their modules and card
+# images are bundled, PIL is not needed since Tk decodes the PNGs itself.
+import os
+
+GAME_DIR = 'playingcard-mini/playingcard-mini'
 
 
 a = Analysis(
     ['client1.1.3.py'],
-    pathex=[],
+    pathex=[os.path.join(SPECPATH, GAME_DIR)],
     binaries=[],
-    datas=[],
-    hiddenimports=[],
+    datas=[(os.path.join(GAME_DIR, '*.png'), GAME_DIR)],
+    hiddenimports=['brackjack', 'slot'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=['PIL'],
     noarchive=False,
     optimize=0,
 )
@@ -0,0 +1,200 @@
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+# Shared by server_app and client_app; keep both copies identical.
+#
+# LAN discovery over UDP. A running server announces itself to a multicast
+# group every ANNOUNCE_INTERVAL seconds and answers PROBE datagrams sent to
+# that group, to the subnet broadcast address or straight to its own IP.
+# Clients use the source address of the reply, so no IP is carried in the
+# packet. Everything also works against 127.0.0.1 without any real network.
+DISCOVERY_PORT = 5556
+MULTICAST_GROUP = "239.255.76.67"
+ANNOUNCE_INTERVAL = 5.0
+PROBE_TIMEOUT = 0.5
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".lesnetchat_servers.json")
+CACHE_SIZE = 8
+
+MAGIC = b"LNCD"
+ANNOUNCE = 1
+PROBE = 2
+REPLY = 3
+PACKET = struct.Struct("!4sBH")  # magic, kind, chat port, followed by the UTF-8 server name
+
+
+def pack_packet(kind, port=0, name=""):
+    return PACKET.pack(MAGIC, kind, port) + name.encode('utf-8')[:200]
+
+
+def unpack_packet(data):
+    # Returns (kind, port, name), or None for anything that is not ours.
+    if len(data) < PACKET.size:
+        return None
+    magic, kind, port = PACKET.unpack_from(data)
+    if magic != MAGIC:
+        return None
+    return kind, port, data[PACKET.size:].decode('utf-8', 'replace')
+
+
+def local_addresses():
+    # IPv4 addresses of this machine, non-loopback first, found without
+    # sending anything anywhere.
+    addresses = []
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.append(info[4][0])
+    except socket.gaierror:
+        pass
+    if sys.platform.startswith("linux") and all(ip.startswith("127.") for ip in addresses):
+        addresses += _linux_interface_addresses()  # hostname often maps to 127.0.1.1 only
+    unique = list(dict.fromkeys(addresses))
+    unique.sort(key=lambda ip: ip.startswith("127."))
+    return unique or ["127.0.0.1"]
+
+
+def _linux_interface_addresses():
+    import fcntl
+    SIOCGIFADDR = 0x8915
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            try:
+                request = struct.pack("256s", name.encode()[:15])
+                addresses.append(socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFADDR, request)[20:24]))
+            except OSError:
+                continue  # interface without an IPv4 address
+    return addresses
+
+
+class DiscoveryResponder:
+    # Server side: one daemon thread that announces and answers probes.
+    def __init__(self, chat_port, name=None, port=DISCOVERY_PORT, group=MULTICAST_GROUP,
+                 interval=ANNOUNCE_INTERVAL):
+        self.chat_port = chat_port
+        self.name = name or socket.gethostname()
+        self.port = port
+        self.group = group
+        self.interval = interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", port))
+        try:
+            membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # stay on the LAN
+        except OSError:
+            pass  # no multicast route; unicast and broadcast probes still work
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="discovery", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(1)
+        self.sock.close()
+
+    def _run(self):
+        reply = pack_packet(REPLY, self.chat_port, self.name)
+        announce = pack_packet(ANNOUNCE, self.chat_port, self.name)
+        next_announce = 0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_announce:
+                try:
+                    self.sock.sendto(announce, (self.group, self.port))
+                except OSError:
+                    pass
+                next_announce = now + self.interval
+            try:
+                readable, _, _ = select.select([self.sock], [], [], min(next_announce - now, 0.5))
+                if readable:
+                    data, addr = self.sock.recvfrom(1024)
+                    packet = unpack_packet(data)
+                    if packet and packet[0] == PROBE:
+                        self.sock.sendto(reply, addr)
+            except OSError:
+                if self._stop.is_set():
+                    break
+
+
+def discover(timeout=PROBE_TIMEOUT, hosts=(), port=DISCOVERY_PORT, group=MULTICAST_GROUP, broadcast=True,
+             first=False):
+    # Client side: probe the given hosts (e.g. cached servers), the multicast
+    # group and the broadcast address, and collect replies until the timeout.
+    # With first=True, returns as soon as anyone answers.
+    # Returns a list of (ip, chat_port, name).
+    found = {}
+    probe = pack_packet(PROBE)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        targets = list(hosts)
+        if group:
+            targets.append(group)
+        if broadcast:
+            targets.append("255.255.255.255")
+        for host in targets:
+            try:
+                sock.sendto(probe, (host, port))
+            except OSError:
+                continue  # unreachable target, try the rest
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                break
+            data, addr = sock.recvfrom(1024)
+            packet = unpack_packet(data)
+            if packet and packet[0] in (REPLY, ANNOUNCE):
+                found[(addr[0], packet[1])] = packet[2]
+                if first:
+                    break
+    return [(ip, chat_port, name) for (ip, chat_port), name in found.items()]
+
+
+class ServerCache:
+    # Most recently used servers, newest first, kept in a small JSON file.
+    def __init__(self, path=CACHE_FILE, size=CACHE_SIZE):
+        self.path = path
+        self.size = size
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.servers = [tuple(entry) for entry in json.load(f)][:size]
+        except (OSError, ValueError, TypeError):
+            self.servers = []
+
+    def remember(self, ip, port, name=""):
+        for entry in self.servers:
+            if entry[:2] == (ip, port):
+                name = name or entry[2]  # keep the name from an earlier discovery
+        self.servers = [entry for entry in self.servers if entry[:2] != (ip, port)]
+        self.servers.insert(0, (ip, port, name))
+        del self.servers[self.size:]
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.servers, f)
+        except OSError:
+            pass  # a read-only home directory just means no cache
+
+    def hosts(self):
+        return list(dict.fromkeys(ip for ip, _, _ in self.servers))
+
+    def lookup(self, timeout=PROBE_TIMEOUT):
+        # Cached servers are probed by unicast first, which answers in
+        # milliseconds; only fall back to multicast/broadcast if none reply.
+        if self.servers:
+            found = discover(min(timeout, 0.2), self.hosts(), group=None, broadcast=False, first=True)
+            if found:
+                return found
+        return discover(timeout, self.hosts())
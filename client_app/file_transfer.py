@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+from protocol import CHUNK_SIZE, TRANSFER_WINDOW, blob_hash
+
+TRANSFER_TIMEOUT = 120  # seconds without credit from the server before an upload gives up
+HASH_BLOCK = 1024 * 1024
+TOKEN_SIZE = 8
+
+
+def format_size(size):
+    if size < 1024:
+        return f"{size} B"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} KiB"
+    return f"{size / (1024 * 1024):.1f} MiB"
+
+
+def hash_file(path):
+    # The transfer id: files with the same content get the same id.
+    digest = blob_hash()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def open_file(path):
+    # With whatever the system uses for that kind of file.
+    if hasattr(os, "startfile"):
+        os.startfile(path)  # Windows
+    else:
+        import subprocess  # rarely needed, kept off the startup path
+        subprocess.Popen(["open" if sys.platform == "darwin" else "xdg-open", path])
+
+
+class Upload:
+    # A file we are sending. The upload thread waits in next_offset() until
+    # the server's credit allows another chunk; ack() is called from the
+    # receive thread. After a reconnect restart() makes it wait for the
+    # server to say where to go on from.
+    def __init__(self, path, transfer_id):
+        self.id = transfer_id
+        self.token = os.urandom(TOKEN_SIZE)  # tells the server a resumed upload is still ours
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.offset = 0  # next chunk to send
+        self.acked = 0   # the server has everything before this
+        self.limit = 0
+        self.resync = True  # waiting for the server's first ACK
+        self.failed = False
+        self.deduplicated = False  # the server had the file already
+        self._cond = threading.Condition()
+
+    def restart(self):
+        with self._cond:
+            self.resync = True
+            self.limit = 0
+
+    def ack(self, offset, limit):
+        with self._cond:
+            if not limit:
+                self.failed = True  # refused, the server sent a notice
+            else:
+                if self.resync:
+                    self.deduplicated = self.deduplicated or (offset == self.size and not self.acked)
+                    self.offset = offset
+                    self.resync = False
+                self.acked = offset
+                self.limit = max(self.limit, limit)
+            self._cond.notify_all()
+
+    def next_offset(self, timeout=TRANSFER_TIMEOUT):
+        # Offset of the next chunk to send, None once all are sent or on failure.
+        with self._cond:
+            while not self.failed and (self.resync or self.offset < self.size and self.offset >= self.limit):
+                if not self._cond.wait(timeout):
+                    self.failed = True
+            if self.failed or self.offset >= self.size:
+                return None
+            return self.offset
+
+    def sent(self, offset, nbytes):
+        with self._cond:
+            if self.offset == offset and not self.resync:  # not reset by a reconnect meanwhile
+                self.offset += nbytes
+
+    def finished(self, timeout=TRANSFER_TIMEOUT):
+        # Waits for the server to confirm the whole file.
+        with self._cond:
+            while not self.failed and self.acked < self.size:
+                if not self._cond.wait(timeout):
+                    self.failed = True
+            return not self.failed
+
+
+class Download:
+    # A file we are receiving into `path` + ".part", renamed once complete
+    # and checked against its id. `save_as` is where the user wants a copy,
+    # None to open it. Everything runs on the receive thread.
+    def __init__(self, transfer_id, size, path, save_as=None):
+        self.id = transfer_id
+        self.size = size
+        self.path = path
+        self.save_as = save_as
+        self.part = path + ".part"
+        self.file = open(self.part, "wb")
+        self.digest = blob_hash()
+        self.offset = 0
+        self.limit = TRANSFER_WINDOW  # credit given to the server
+
+    def write(self, offset, data):
+        # Returns True once the file is complete; repeats after a reconnect are ignored.
+        if offset != self.offset:
+            return False
+        if len(data) != min(CHUNK_SIZE, self.size - offset):
+            raise ValueError("Bad chunk size")
+        self.file.write(data)
+        self.digest.update(data)
+        self.offset += len(data)
+        if self.offset < self.size:
+            return False
+        self.file.close()
+        if self.digest.digest() != self.id:
+            os.remove(self.part)
+            raise ValueError("File does not match its hash")
+        os.replace(self.part, self.path)
+        return True
+
+    def credit(self):
+        # A new limit to send once half the window is used, else None.
+        if self.offset < self.size and self.limit - self.offset <= TRANSFER_WINDOW // 2:
+            self.limit = self.offset + TRANSFER_WINDOW
+            return self.limit
+        return None
+
+    def restart(self):
+        # Credit for a new connection, which starts from our offset.
+        self.limit = self.offset + TRANSFER_WINDOW
+        return self.limit
+
+    def cancel(self):
+        self.file.close()
+        try:
+            os.remove(self.part)
+        except OSError:
+            pass
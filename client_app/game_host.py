@@ -0,0 +1,64 @@
+import importlib
+import os
+import sys
+import tkinter as tk
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "playingcard-mini", "playingcard-mini")
+GAMES = {  # name -> (module in GAME_DIR, class taking the window it runs in)
+    "blackjack": ("brackjack", "BlackjackGame"),
+    "slot": ("slot", "SlotGame"),
+}
+CARD_SUFFIX = "@2x.png"
+
+
+class GameHost:
+    # Runs the games in Toplevel windows of the client itself instead of a
+    # new python per game: no interpreter, Tk or image decoding to pay for
+    # on each click, and it works in the frozen exe, where there is no
+    # python to start. Card images are decoded once, by Tk's own PNG
+    # support, and shared by every table opened since. Each game closes its
+    # window itself (WM_DELETE_WINDOW), cancelling its pending after() calls
+    # first, so none of them fires on a destroyed widget in our mainloop.
+    def __init__(self, master):
+        self.master = master
+        self.windows = {}  # game name -> its open Toplevel
+        self._cards = None
+
+    def open(self, name):
+        # Brings the game up, or to the front if it is open already.
+        window = self.windows.get(name)
+        if window is not None and window.winfo_exists():
+            window.deiconify()
+            window.lift()
+            window.focus_force()
+            return window
+        module_name, class_name = GAMES[name]
+        game_class = getattr(load_game(module_name), class_name)
+        window = tk.Toplevel(self.master)
+        try:
+            if name == "blackjack":
+                window.game = game_class(window, card_images=self.card_images())
+            else:
+                window.game = game_class(window)
+        except Exception:
+            window.destroy()
+            raise
+        self.windows[name] = window
+        return window
+
+    def card_images(self):
+        if self._cards is None:
+            self._cards = {}
+            for filename in os.listdir(GAME_DIR):
+                if filename.endswith(CARD_SUFFIX):
+                    self._cards[filename[:-len(CARD_SUFFIX)]] = tk.PhotoImage(
+                        master=self.master, file=os.path.join(GAME_DIR, filename))
+        return self._cards
+
+
+def load_game(module_name):
+    # The game scripts still run on their own too, so they stay plain
+    # top-level modules in GAME_DIR (bundled as hidden imports when frozen).
+    if GAME_DIR not in sys.path:
+        sys.path.append(GAME_DIR)
+    return importlib.import_module(module_name)
@@ -0,0 +1,66 @@
+import time
+
+GAP_TIMEOUT = 2.0  # seconds to wait for a missing message before skipping it
+
+
+class ReorderBuffer:
+    # Hands out sequenced messages strictly in sequence order. A message that
+    # arrives after a gap (the server's send queue dropped something for us)
+    # waits here while the missing range is requested from the server's
+    # history; if the gap is still open after gap_timeout it is skipped.
+    # Records are tuples that start with the sequence number.
+    def __init__(self, gap_timeout=GAP_TIMEOUT):
+        self.gap_timeout = gap_timeout
+        self.last_seq = None  # last sequence number handed out
+        self.pending = {}     # seq -> record waiting behind a gap
+        self.requested = 0    # highest seq already asked for
+        self.gap_since = None
+        self.skipped = 0
+
+    def push(self, records):
+        # Returns (records now in order, (after_seq, count) to request or None).
+        for record in records:
+            seq = record[0]
+            if self.last_seq is None:
+                self.last_seq = seq - 1  # the first thing we see sets the baseline
+            if seq > self.last_seq:
+                self.pending.setdefault(seq, record)  # duplicates are dropped
+        return self._release(), self._missing()
+
+    def expire(self):
+        # Gives up on a gap that has been open too long and returns the
+        # records that were waiting behind it.
+        if not self.pending or time.monotonic() - self.gap_since < self.gap_timeout:
+            return []
+        first = min(self.pending)
+        self.skipped += first - self.last_seq - 1
+        self.last_seq = first - 1
+        self.gap_since = None
+        return self._release()
+
+    def timeout(self):
+        # Seconds until expire() has something to do, None without a gap.
+        if not self.pending:
+            return None
+        return max(0.0, self.gap_since + self.gap_timeout - time.monotonic())
+
+    def _release(self):
+        ready = []
+        while self.last_seq + 1 in self.pending:
+            self.last_seq += 1
+            ready.append(self.pending.pop(self.last_seq))
+        if not self.pending:
+            self.gap_since = None
+        elif self.gap_since is None:
+            self.gap_since = time.monotonic()
+        return ready
+
+    def _missing(self):
+        if not self.pending:
+            return None
+        upto = min(self.pending) - 1
+        if upto <= self.requested:
+            return None  # already asked
+        after = max(self.last_seq, self.requested)
+        self.requested = upto
+        return after, upto - after
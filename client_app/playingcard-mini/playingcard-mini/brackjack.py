@@ -3,15 +3,18 @@ import json
 import random
 import tkinter as tk
 from tkinter import messagebox
-from PIL import Image, ImageTk
+
+POINTS_FILE = os.path.join(os.path.expanduser("~"), ".lesnetchat_points.json")  # ユーザーごと。exe の展開先は書き込めないか終了時に消える
 
 class BlackjackGame:
-    def __init__(self, master):
+    def __init__(self, master, card_images=None):
         self.master = master
         self.master.title("Blackjack Game")
         
-        self.card_images = {}
-        self.load_images()
+        self.card_images = card_images  # チャットクライアントから起動した場合は共有の画像
+        if self.card_images is None:
+            self.card_images = {}
+            self.load_images()
         
         self.deck = self.create_deck()
         self.player_hand = []
@@ -19,11 +22,14 @@ class BlackjackGame:
         
         self.points = self.load_points()
         self.bet = 10
+        self.reset_job = None  # 予約中の reset_game の after id
 
         self.create_ui()
         self.reset_game()
+        self.master.protocol("WM_DELETE_WINDOW", self.close)
 
     def load_images(self):
+        from PIL import Image, ImageTk  # 単独で起動したときだけ使う
         directory = os.path.dirname(os.path.abspath(__file__))  # 現在のスクリプトがあるディレクトリを取得
         for filename in os.listdir(directory):
             if filename.endswith("@2x.png"):
@@ -80,17 +86,23 @@ class BlackjackGame:
 
     def load_points(self):
         try:
-            with open('points.json', 'r') as f:
+            with open(POINTS_FILE, 'r') as f:
                 data = json.load(f)
                 return data.get('points', 100)
-        except (FileNotFoundError, json.JSONDecodeError):
+        except (OSError, json.JSONDecodeError):
             return 100
 
     def save_points(self):
-        with open('points.json', 'w') as f:
-            json.dump({'points': self.points}, f)
+        try:
+            with open(POINTS_FILE, 'w') as f:
+                json.dump({'points': self.points}, f)
+        except OSError:
+            pass  # 保存できなくてもゲームは続ける
 
     def reset_game(self):
+        if self.reset_job is not None:
+            self.master.after_cancel(self.reset_job)
+            self.reset_job = None
         self.deck = self.create_deck()
         self.player_hand = []
         self.dealer_hand = []
@@ -206,7 +218,14 @@ class BlackjackGame:
         self.save_points()
         self.hit_button.config(state=tk.DISABLED)
         self.stand_button.config(state=tk.DISABLED)
-        self.master.after(3000, self.reset_game)  # 3秒後にゲームをリセット
+        self.reset_job = self.master.after(3000, self.reset_game)  # 3秒後にゲームをリセット
+
+    def close(self):
+        # 閉じたウィンドウに予約済みの after が走らないように取り消してから破棄する
+        if self.reset_job is not None:
+            self.master.after_cancel(self.reset_job)
+            self.reset_job = None
+        self.master.destroy()
 
     def update_points(self):
         self.points_label.config(text=f"Points: {self.points}")
@@ -4,6 +4,8 @@ import random
 import json
 import os
 
+POINTS_FILE = os.path.join(os.path.expanduser("~"), ".lesnetchat_points.json")  # ユーザーごと。exe の展開先は書き込めないか終了時に消える
+
 class SlotGame:
     def __init__(self, master):
         self.master = master
@@ -13,8 +15,10 @@ class SlotGame:
         
         self.load_points()
         self.bet = 10  # 初期の掛けポイント
+        self.spin_job = None  # 予約中の spin_reels の after id
         
         self.create_ui()
+        self.master.protocol("WM_DELETE_WINDOW", self.close)
         
     def create_ui(self):
         self.label = tk.Label(self.master, text="Press Start to play")
@@ -74,9 +78,12 @@ class SlotGame:
         self.spin_reels()
     
     def spin_reels(self):
+        if self.spin_job is not None:
+            self.master.after_cancel(self.spin_job)  # アニメーションは常に1本だけ
+            self.spin_job = None
         if any(self.spinning):
             self.update_reels()
-            self.master.after(100, self.spin_reels)
+            self.spin_job = self.master.after(100, self.spin_reels)
         else:
             self.check_result()
             self.start_button.config(state=tk.NORMAL)  # スタートボタンを有効化
@@ -137,15 +144,25 @@ class SlotGame:
         self.save_points()
     
     def load_points(self):
-        if os.path.exists('points.json'):
-            with open('points.json', 'r') as f:
+        try:
+            with open(POINTS_FILE, 'r') as f:
                 self.points = json.load(f).get('points', 100)
-        else:
+        except (OSError, ValueError):
             self.points = 100
     
+    def close(self):
+        # 閉じたウィンドウに予約済みの after が走らないように取り消してから破棄する
+        if self.spin_job is not None:
+            self.master.after_cancel(self.spin_job)
+            self.spin_job = None
+        self.master.destroy()
+    
     def save_points(self):
-        with open('points.json', 'w') as f:
-            json.dump({'points': self.points}, f)
+        try:
+            with open(POINTS_FILE, 'w') as f:
+                json.dump({'points': self.points}, f)
+        except OSError:
+            pass  # 保存できなくてもゲームは続ける
     
 if __name__ == "__main__":
     root = tk.Tk()
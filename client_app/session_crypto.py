@@ -0,0 +1,74 @@
+import itertools
+import os
+import struct
+from cryptography.exceptions import InvalidTag  # re-exported for callers
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Shared by server_app and client_app; keep both copies identical.
+#
+# Session setup: the server sends its X25519 public key, the client answers
+# with its own, and both sides derive a per-connection uplink key with HKDF.
+# The server then sends the shared broadcast key encrypted under that uplink
+# key. Client -> server messages use the uplink key, server -> client
+# messages use the broadcast key, so a broadcast is still encrypted once.
+# A reconnecting client can skip the key exchange with the ticket from its
+# last WELCOME; both sides then derive a fresh uplink key with resume_key()
+# from a client nonce and a server nonce, the latter sent in the clear in
+# front of the encrypted WELCOME.
+AES_GCM = 1
+CHACHA20_POLY1305 = 2
+ALGORITHMS = {AES_GCM: AESGCM, CHACHA20_POLY1305: ChaCha20Poly1305}
+ALGORITHM_NAMES = {"aes-gcm": AES_GCM, "chacha20": CHACHA20_POLY1305}
+
+KEY_SIZE = 32
+PUBLIC_KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+RESUME_NONCE_SIZE = 16
+_NONCE_COUNTER = struct.Struct("!Q")
+
+
+def new_key():
+    return os.urandom(KEY_SIZE)
+
+
+def resume_key(key, client_nonce, server_nonce):
+    # New uplink key for a resumed session, so the old key never starts a
+    # second nonce sequence. Both sides add a nonce: a replayed RESUME still
+    # gets a key of its own from the server's fresh one.
+    return HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=client_nonce + server_nonce,
+                info=b"lesnet resume").derive(key)
+
+
+class SessionCipher:
+    # The AEAD context is built once per key and reused for every message.
+    # Nonces are a random 4-byte prefix fixed for this context plus a 64-bit
+    # counter, so they never repeat for the lifetime of the context.
+    def __init__(self, key, algorithm=AES_GCM):
+        self.key = key
+        self.algorithm = algorithm
+        self._aead = ALGORITHMS[algorithm](key)
+        self._prefix = os.urandom(4)
+        self._counter = itertools.count()
+
+    def encrypt(self, plaintext, aad=None):
+        nonce = self._prefix + _NONCE_COUNTER.pack(next(self._counter))
+        return nonce + self._aead.encrypt(nonce, plaintext, aad)
+
+    def decrypt(self, data, aad=None):
+        # Raises InvalidTag if the message was tampered with or the key is wrong.
+        return self._aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], aad)
+
+
+class KeyExchange:
+    def __init__(self):
+        self._private = X25519PrivateKey.generate()
+        self.public_bytes = self._private.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+    def derive(self, peer_public_bytes, info=b"lesnet uplink"):
+        shared = self._private.exchange(X25519PublicKey.from_public_bytes(peer_public_bytes))
+        return HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=None, info=info).derive(shared)
@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+from connection import BaseConnection, configure_keepalive
+from discovery import DiscoveryResponder
+from history import HistoryStore, HISTORY_FILE, REPLAY_COUNT
+from hub import ChatHub, ProtocolError, REAP_TICK
+from metrics import MetricsServer, METRICS_PORT
+from protocol import FrameDecoder, FrameError, RECV_SIZE
+from rate_limit import add_rate_limit_arguments, flood_guard_from_args
+from send_queue import SendQueue, DROP_OLDEST, FLUSH_WINDOW, OVERFLOW_POLICIES, SEND_QUEUE_SIZE
+from session_crypto import AES_GCM, ALGORITHM_NAMES, InvalidTag
+
+BROADCAST_PORT = 5555
+BUFFER_SIZE = RECV_SIZE
+
+log = logging.getLogger("lesnet.server")
+
+WRITE_BUFFER_LIMIT = 64 * 1024
+
+
+class AsyncClientConnection(BaseConnection):
+    # While the transport keeps up, frames are written straight through.
+    # Once its buffer passes WRITE_BUFFER_LIMIT, frames go to a bounded
+    # SendQueue that write_loop() drains after each drain(), so a slow peer
+    # only ever fills its own queue. With a flush window every frame is
+    # queued and written in batches instead. File downloads go out from
+    # write_loop() with loop.sendfile(), one frame at a time and only while
+    # the queue is empty; meanwhile send() queues instead of writing through.
+    def __init__(self, client_id, reader, writer, queue_size=SEND_QUEUE_SIZE, policy=DROP_OLDEST, flush_window=0.0):
+        self._ready = asyncio.Event()
+        super().__init__(client_id, writer.get_extra_info("peername"),
+                         SendQueue(queue_size, policy, on_ready=self._ready.set, flush_window=flush_window))
+        self.reader = reader
+        self.writer = writer
+        self.sending_file = False  # the transport refuses write() during sendfile
+
+    def send(self, frame):
+        if (not self.queue.flush_window and not len(self.queue) and not self.queue.closed and not self.sending_file
+                and self.writer.transport.get_write_buffer_size() < WRITE_BUFFER_LIMIT):
+            self.writer.write(frame)
+            self.record_sent(len(frame))
+            return True
+        return self.queue.put(frame)
+
+    async def write_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                bulk = self.next_download()
+                if bulk is None:
+                    await self._ready.wait()
+                self._ready.clear()
+                await self._coalesce()
+                frames = self.queue.drain()
+                if frames:
+                    queued_at = self.queue.batch_started
+                    self.writer.writelines(frames)
+                    await self.writer.drain()
+                    self.record_sent(sum(len(frame) for frame in frames), queued_at)
+                elif self.queue.closed:
+                    break
+                elif bulk is not None:
+                    download, (offset, count) = bulk
+                    self.sending_file = True
+                    try:
+                        await loop.sendfile(self.writer.transport, download.file, offset, count)
+                    finally:
+                        self.sending_file = False
+                    download.sent(count)
+                    self.record_file_sent(count)
+        except OSError:
+            pass  # connection reset, or a file closed under a running download
+        finally:
+            self.queue.close()
+            self.close_transfers()
+            self.writer.close()
+
+    async def _coalesce(self):
+        # Let more frames pile up until the flush window ends or the byte
+        # budget is reached; writelines() then hands them over as one batch.
+        while True:
+            delay = self.queue.flush_delay()
+            if not delay:
+                return
+            try:
+                await asyncio.wait_for(self._ready.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+
+    def close(self, flush=True):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        if not flush:
+            self.writer.transport.abort()
+
+
+class AsyncChatServer:
+    # Headless single-event-loop server. Same wire protocol as ChatServer,
+    # but every connection is a pair of asyncio streams instead of a thread.
+    def __init__(self, host="0.0.0.0", port=BROADCAST_PORT, on_message=None, stats_interval=60,
+                 queue_size=SEND_QUEUE_SIZE, overflow_policy=DROP_OLDEST, flush_window=0.0, algorithm=AES_GCM,
+                 history_file=HISTORY_FILE, replay_count=REPLAY_COUNT, metrics_port=None, profile=False,
+                 reuse_port=False, hub=None, discovery=False, flood_guard=None):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.flush_window = flush_window
+        self.stats_interval = stats_interval
+        self.on_message = on_message or self.display
+        if hub is None:
+            history = HistoryStore(history_file) if history_file else None
+            hub = ChatHub(self.on_message, algorithm, queue_size, history, replay_count, flood_guard=flood_guard)
+        self.hub = hub
+        self.reuse_port = reuse_port  # several processes sharing one port, see cluster.py
+        self.clients = self.hub.clients
+        self.metrics_port = metrics_port  # local stats endpoint, None to disable
+        self.profile = profile
+        self.metrics_server = None
+        self.discovery = discovery  # answer LAN discovery probes while running
+        self.responder = None
+        self.server = None
+        self.handlers = set()
+        self.stop_event = None
+        self.reaper = None
+        self.is_running = False
+
+    def display(self, message):
+        log.info("%s", message)
+
+    async def handle_client(self, reader, writer):
+        client = AsyncClientConnection(self.clients.next_id(), reader, writer,
+                                       self.queue_size, self.overflow_policy, self.flush_window)
+        addr = client.addr
+        configure_keepalive(writer.get_extra_info("socket"))
+        self.on_message(f"Connected with {addr}")
+        self.hub.open(client)
+        write_task = asyncio.create_task(client.write_loop())
+        self.handlers.add(asyncio.current_task())
+        decoder = FrameDecoder()
+        try:
+            while self.is_running:
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                for msg_type, payload in decoder.feed(data):
+                    self.hub.handle_frame(client, msg_type, payload)
+        except (OSError, FrameError, ProtocolError, InvalidTag, UnicodeDecodeError) as e:
+            # OSError covers resets and keepalive timeouts as well as failed spool reads and writes.
+            log.debug("Client %s dropped: %r", addr, e)
+        finally:
+            self.hub.remove_client(client)
+            await write_task
+            self.handlers.discard(asyncio.current_task())
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, reuse_address=True, reuse_port=self.reuse_port or None,
+            backlog=1024)
+        self.is_running = True
+        self.hub.loop = asyncio.get_running_loop()
+        self.reaper = asyncio.create_task(self.reap_clients())
+        self.on_message(f"Server started on {self.host}:{self.port}...")
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = MetricsServer(self.hub.metrics, self.hub.stats, port=self.metrics_port).start()
+            except OSError as e:
+                log.warning("Metrics endpoint unavailable: %s", e)
+            else:
+                host, port = self.metrics_server.address
+                self.on_message(f"Metrics on http://{host}:{port}/metrics")
+                if self.profile:
+                    self.metrics_server.profiler.start()
+        if self.discovery:
+            try:
+                self.responder = DiscoveryResponder(self.port).start()
+            except OSError as e:
+                log.warning("Discovery unavailable: %s", e)
+
+    async def reap_clients(self):
+        # One task for all connections: closes the ones gone silent.
+        while True:
+            await asyncio.sleep(REAP_TICK)
+            self.hub.reap_idle()
+
+    async def stop(self):
+        if not self.is_running:
+            return
+        self.is_running = False
+        self.reaper.cancel()
+        self.server.close()
+        self.hub.shutdown()
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=5)
+        await self.server.wait_closed()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.responder is not None:
+            self.responder.stop()
+        self.on_message("Server stopped...")
+
+    async def serve_forever(self):
+        await self.start()
+        stop_event = self.stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: fall back to KeyboardInterrupt
+        try:
+            while not stop_event.is_set():
+                try:
+                    await asyncio.wait_for(stop_event.wait(), self.stats_interval)
+                except asyncio.TimeoutError:
+                    log.info("%s", self.hub.broadcast_stats.summary())
+                    log.info("%s", self.hub.queue_summary())
+        finally:
+            await self.stop()
+
+
+def raise_fd_limit():
+    # Thousands of idle sockets need more than the usual 1024 descriptors.
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless LesNETchat server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=BROADCAST_PORT)
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--queue-size", type=int, default=SEND_QUEUE_SIZE, help="outbound frames buffered per client")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default=DROP_OLDEST)
+    parser.add_argument("--coalesce", type=float, nargs="?", const=FLUSH_WINDOW * 1000, default=0, metavar="MS",
+                        help=f"batch outbound frames for up to MS milliseconds (default {FLUSH_WINDOW * 1000:g} when given)")
+    parser.add_argument("--history", default=HISTORY_FILE, help="SQLite history file, empty to disable")
+    parser.add_argument("--replay", type=int, default=REPLAY_COUNT, help="messages replayed to joining clients")
+    parser.add_argument("--cipher", choices=sorted(ALGORITHM_NAMES), default="aes-gcm")
+    parser.add_argument("--stats-interval", type=float, default=60, help="seconds between broadcast timing logs")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="local /metrics, /stats and /profile endpoint, 0 to disable")
+    parser.add_argument("--profile", action="store_true", help="start the sampling profiler right away")
+    parser.add_argument("--no-discovery", action="store_true", help="do not answer LAN discovery probes")
+    add_rate_limit_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    raise_fd_limit()
+    try:
+        import uvloop  # optional, faster event loop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    server = AsyncChatServer(args.host, args.port, stats_interval=args.stats_interval,
+                             queue_size=args.queue_size, overflow_policy=args.overflow_policy,
+                             flush_window=args.coalesce / 1000,
+                             algorithm=ALGORITHM_NAMES[args.cipher], history_file=args.history,
+                             replay_count=args.replay, metrics_port=args.metrics_port or None,
+                             profile=args.profile, discovery=not args.no_discovery,
+                             flood_guard=flood_guard_from_args(args))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
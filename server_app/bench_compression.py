@@ -0,0 +1,98 @@
+import argparse
+import json
+import random
+import time
+from hub import chat_frame, history_frame
+from payload_codec import decode_payload, supported, CODEC_RAW, CODEC_ZLIB, CODEC_ZSTD, UNPREFIXED
+from protocol import CHAT_HEADER, HEADER_SIZE, unpack_history
+from session_crypto import AES_GCM, SessionCipher, new_key
+
+# Wire size and CPU cost of each payload codec for what the server actually
+# sends: single broadcast lines (chat_frame, built once per message) and
+# history replays (history_frame), and the client side of both
+# (decrypt + decode as in ChatClient.receive).
+#   python bench_compression.py --messages 5000 --batch 100
+
+CODEC_NAMES = {UNPREFIXED: "off", CODEC_RAW: "raw", CODEC_ZLIB: "zlib", CODEC_ZSTD: "zstd"}
+NICKNAMES = ["taro", "hanako", "kenji", "yuki", "alice", "bob", "sensei", "student12"]
+PHRASES = [
+    "hi", "ok", "yes", "thanks!", "わかりました", "ありがとうございます",
+    "I don't understand the question, can you explain that again please?",
+    "What is the answer to question 3 of the homework?",
+    "先生、宿題の提出はいつまでですか?",
+    "すみません、もう一度説明してください。",
+    "Is this going to be on the test next week?",
+    "https://example.com/lecture/slides-week5.pdf",
+    "I think the answer is 42 because the loop runs six times seven.",
+]
+
+
+def sample_messages(count, seed=1):
+    rng = random.Random(seed)
+    return [f"{rng.choice(NICKNAMES)}: {rng.choice(PHRASES)}" for _ in range(count)]
+
+
+def bench_broadcast(group, messages, codec):
+    bodies = [message.encode('utf-8') for message in messages]
+    started = time.perf_counter()
+    frames = [chat_frame(group, seq, time.time(), 1, body, codec) for seq, body in enumerate(bodies, 1)]
+    encoded = time.perf_counter()
+    for frame in frames:
+        payload = frame[HEADER_SIZE:]
+        header = payload[:CHAT_HEADER.size]
+        decode_payload(codec, group.decrypt(payload[CHAT_HEADER.size:], header)).decode('utf-8')
+    decoded = time.perf_counter()
+    return {
+        "plain_bytes": sum(len(body) for body in bodies),
+        "wire_bytes": sum(len(frame) for frame in frames),
+        "encode_us": round((encoded - started) / len(frames) * 1e6, 2),
+        "decode_us": round((decoded - encoded) / len(frames) * 1e6, 2),
+    }
+
+
+def bench_history(group, messages, codec, batch):
+    batches = [[(seq, time.time(), message) for seq, message in enumerate(messages[i:i + batch], i + 1)]
+               for i in range(0, len(messages), batch)]
+    started = time.perf_counter()
+    frames = [history_frame(group, records, codec) for records in batches]
+    encoded = time.perf_counter()
+    for frame in frames:
+        unpack_history(decode_payload(codec, group.decrypt(frame[HEADER_SIZE:])))
+    decoded = time.perf_counter()
+    return {
+        "plain_bytes": sum(len(message.encode('utf-8')) for message in messages),
+        "wire_bytes": sum(len(frame) for frame in frames),
+        "encode_us": round((encoded - started) / len(frames) * 1e6, 2),
+        "decode_us": round((decoded - encoded) / len(frames) * 1e6, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare payload codecs on chat and history frames")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=100, help="records per history frame")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    group = SessionCipher(new_key(), AES_GCM)
+    messages = sample_messages(args.messages)
+    codecs = [UNPREFIXED, CODEC_RAW] + list(supported())[::-1]
+    results = {}
+    for kind, run in (("broadcast", lambda codec: bench_broadcast(group, messages, codec)),
+                      ("history", lambda codec: bench_history(group, messages, codec, args.batch))):
+        baseline = None
+        for codec in codecs:
+            result = run(codec)
+            baseline = baseline or result["wire_bytes"]
+            result["saved_pct"] = round((1 - result["wire_bytes"] / baseline) * 100, 1)
+            results.setdefault(kind, {})[CODEC_NAMES[codec]] = result
+            print(f"{kind:<9} {CODEC_NAMES[codec]:<5} {result['wire_bytes']:>9} B on the wire "
+                  f"({result['saved_pct']:>5}% saved)  {result['encode_us']:>8} us/frame to build"
+                  f"  {result['decode_us']:>8} us/frame to read")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import time
+import warnings
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+from session_crypto import AES_GCM, CHACHA20_POLY1305, SessionCipher, new_key
+
+try:
+    from cryptography.hazmat.decrepit.ciphers.modes import CFB
+except ImportError:
+    from cryptography.hazmat.primitives.ciphers.modes import CFB
+
+# Micro-benchmark: the old per-message AES-CFB path (new Cipher object for
+# every message, fixed key/IV) against the reusable AEAD session contexts.
+#   python bench_crypto.py --messages 20000 --sizes 64 512 4096
+
+
+class LegacyCFB:
+    # What ChatServer/ChatClient did up to 1.0.2 / 1.1.3.
+    def __init__(self):
+        self.key = os.urandom(32)
+        self.iv = os.urandom(16)
+
+    def encrypt(self, plaintext):
+        encryptor = Cipher(algorithms.AES(self.key), CFB(self.iv)).encryptor()
+        return encryptor.update(plaintext) + encryptor.finalize()
+
+    def decrypt(self, ciphertext):
+        decryptor = Cipher(algorithms.AES(self.key), CFB(self.iv)).decryptor()
+        return decryptor.update(ciphertext) + decryptor.finalize()
+
+
+def run(cipher, payload, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        cipher.decrypt(cipher.encrypt(payload))
+    elapsed = time.perf_counter() - started
+    return {"msgs_per_sec": round(count / elapsed), "us_per_msg": round(elapsed / count * 1e6, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare chat message crypto paths")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 512, 4096])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")  # CFB deprecation warnings
+    ciphers = {
+        "aes-cfb (legacy)": LegacyCFB(),
+        "aes-gcm": SessionCipher(new_key(), AES_GCM),
+        "chacha20-poly1305": SessionCipher(new_key(), CHACHA20_POLY1305),
+    }
+    results = {}
+    for size in args.sizes:
+        payload = os.urandom(size)
+        for name, cipher in ciphers.items():
+            result = run(cipher, payload, args.messages)
+            results.setdefault(str(size), {})[name] = result
+            print(f"{size:>6} B  {name:<18} {result['msgs_per_sec']:>9} msg/s  {result['us_per_msg']:>8} us/msg"
+                  "  (encrypt + decrypt)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
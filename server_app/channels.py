@@ -0,0 +1,56 @@
+import math
+import time
+
+RATE_WINDOW = 60.0  # seconds the message rate is averaged over
+MAX_CHANNELS = 256
+MAX_SUBSCRIPTIONS = 16  # channels per connection, the lobby included
+
+
+class RateMeter:
+    # Exponentially decaying message rate: O(1) per event, no sample buffer.
+    def __init__(self, window=RATE_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._rate = 0.0
+        self._updated = clock()
+
+    def _decay(self):
+        now = self.clock()
+        self._rate *= math.exp(-(now - self._updated) / self.window)
+        self._updated = now
+
+    def record(self, count=1):
+        self._decay()
+        self._rate += count / self.window
+
+    def per_second(self):
+        self._decay()
+        return self._rate
+
+
+class Channel:
+    # One room. `subscribers` is the fan-out index: a broadcast only touches
+    # the connections in it, however many others the server has. Changed
+    # and iterated with the hub's _publish_lock held.
+    def __init__(self, channel_id, name, history=None):
+        self.id = channel_id
+        self.name = name
+        self.history = history  # HistoryStore, or None to keep no history
+        self.last_seq = history.last_seq if history is not None else 0
+        self.subscribers = set()
+        self.messages = 0
+        self.rate = RateMeter()
+
+    def record(self):
+        self.messages += 1
+        self.rate.record()
+
+    def info(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "subscribers": len(self.subscribers),
+            "messages": self.messages,
+            "last_seq": self.last_seq,
+            "msgs_per_sec": round(self.rate.per_second(), 2),
+        }
@@ -0,0 +1,336 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+from async_server import AsyncChatServer, BROADCAST_PORT, raise_fd_limit
+from discovery import DiscoveryResponder
+from history import HistoryStore, HISTORY_FILE, REPLAY_COUNT, channel_table
+from channels import Channel
+from hub import ChatHub, FrameVariants, MAX_HISTORY_BATCH, chat_frame, history_frame
+from metrics import METRICS_PORT
+from payload_codec import supported, CODEC_RAW, UNPREFIXED
+from protocol import encode_frame, FrameDecoder, CHANNEL, HEADER, HEADER_SIZE, LOBBY, LOBBY_ID, RECV_SIZE
+from rate_limit import add_rate_limit_arguments, flood_guard_from_args
+from registry import ClientRegistry
+from send_queue import DROP_OLDEST, FLUSH_WINDOW, OVERFLOW_POLICIES, SEND_QUEUE_SIZE
+from session_crypto import ALGORITHM_NAMES, SessionCipher, new_key
+from transfers import FileSpool
+
+# Multi-process mode: N worker processes share the listening port through
+# SO_REUSEPORT and each owns the clients the kernel hands it. Workers do the
+# per-client work (handshake, decrypt, fan-out) and pass every chat line in
+# plaintext to the sequencer in the master process over a Unix socket. The
+# sequencer numbers and stores it per channel, encrypts it once per payload
+# codec with the group key and sends the finished frames back to every
+# worker in sequence order, so every client sees every message in the same
+# order. Workers keep the channel subscriber indexes for their own clients.
+# Uploaded files go to a spool directory all workers share, so a file sent
+# through one worker can be downloaded (or resumed) through any other.
+#
+# Link frames (same framing as protocol.py, own message types):
+LINK_PUBLISH = 0x81   # worker -> sequencer: origin client id + channel + UTF-8 message
+LINK_JOIN = 0x82      # worker -> sequencer: client id + channel + replay count + codec
+LINK_HISTORY = 0x83   # worker -> sequencer: client id + channel + after seq + max count + codec
+LINK_RESUME = 0x84    # worker -> sequencer: like LINK_HISTORY; answered like LINK_JOIN
+LINK_DELIVER = 0x91   # sequencer -> workers: channel + chat frames, one per DELIVER_CODECS entry
+LINK_REPLAY = 0x92    # sequencer -> worker: client id + channel + history frame (may be empty); now subscribed
+LINK_SEND = 0x93      # sequencer -> worker: client id + frame for that client only
+
+CLIENT_ID = struct.Struct("!I")
+CLIENT_CHANNEL = struct.Struct("!II")
+JOIN_REQUEST = struct.Struct("!IIIB")
+HISTORY_LOOKUP = struct.Struct("!IIQIB")
+DELIVER_CODECS = (UNPREFIXED, CODEC_RAW) + tuple(supported())  # every codec a client can end up with
+
+log = logging.getLogger("lesnet.cluster")
+
+
+class Sequencer:
+    # Runs in the master process. Every worker link is handled on one event
+    # loop, so the order in which PUBLISH frames are processed is the order
+    # everyone receives them in.
+    def __init__(self, group_key, algorithm, history_file=HISTORY_FILE):
+        self.group = SessionCipher(group_key, algorithm)
+        self.history_file = history_file
+        self.channels = {}  # channel id -> Channel, named by id: only the workers know the names
+        self.workers = []
+
+    def channel(self, cid):
+        channel = self.channels.get(cid)
+        if channel is None:
+            history = HistoryStore(self.history_file, table=channel_table(cid)) if self.history_file else None
+            channel = self.channels[cid] = Channel(cid, LOBBY if cid == LOBBY_ID else f"{cid:08x}", history)
+        return channel
+
+    async def handle_worker(self, reader, writer):
+        self.workers.append(writer)
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for msg_type, payload in decoder.feed(data):
+                    self.handle(writer, msg_type, payload)
+        except ConnectionError:
+            pass
+        finally:
+            self.workers.remove(writer)
+            writer.close()
+
+    def handle(self, worker, msg_type, payload):
+        if msg_type == LINK_PUBLISH:
+            origin, cid = CLIENT_CHANNEL.unpack_from(payload)
+            body = payload[CLIENT_CHANNEL.size:]
+            channel = self.channel(cid)
+            if channel.history is not None:
+                seq, ts = channel.history.append(body.decode('utf-8'))
+            else:
+                seq, ts = channel.last_seq + 1, time.time()
+            channel.last_seq = seq
+            channel.record()
+            relay = encode_frame(LINK_DELIVER, CHANNEL.pack(cid) + b"".join(
+                chat_frame(self.group, seq, ts, origin, body, codec, cid) for codec in DELIVER_CODECS))
+            for link in self.workers:
+                link.write(relay)  # local processes that only ever fan out, no backpressure needed
+        elif msg_type == LINK_JOIN:
+            client_id, cid, count, codec = JOIN_REQUEST.unpack(payload)
+            history = self.channel(cid).history
+            records = history.last(count) if history is not None and count else []
+            worker.write(encode_frame(LINK_REPLAY, CLIENT_CHANNEL.pack(client_id, cid)
+                                      + history_frame(self.group, records, codec, cid)))
+        elif msg_type == LINK_RESUME:
+            client_id, cid, after, count, codec = HISTORY_LOOKUP.unpack(payload)
+            history = self.channel(cid).history
+            records = history.since(after, count) if history is not None else []
+            worker.write(encode_frame(LINK_REPLAY, CLIENT_CHANNEL.pack(client_id, cid)
+                                      + history_frame(self.group, records, codec, cid)))
+        elif msg_type == LINK_HISTORY:
+            client_id, cid, after, count, codec = HISTORY_LOOKUP.unpack(payload)
+            history = self.channel(cid).history
+            if history is not None:
+                # May wait up to one commit interval on a cold lookup; that
+                # briefly stalls the loop but keeps the stream in order.
+                records = history.since(after, min(count, MAX_HISTORY_BATCH))
+                if records:
+                    worker.write(encode_frame(LINK_SEND, CLIENT_ID.pack(client_id)
+                                              + history_frame(self.group, records, codec, cid)))
+
+    def summary(self):
+        lobby = self.channel(LOBBY_ID)
+        return f"lobby seq {lobby.last_seq} | {len(self.channels)} channels"
+
+    def close(self):
+        for channel in self.channels.values():
+            if channel.history is not None:
+                channel.history.close()
+
+
+class WorkerHub(ChatHub):
+    # ChatHub for one worker: storing, ordering and encrypting broadcasts is
+    # the sequencer's job, this hub only fans finished frames out.
+    def __init__(self, on_message, algorithm, queue_size, group_key, ticket_key, worker_index, workers,
+                 replay_count=REPLAY_COUNT, flood_guard=None, files=None):
+        super().__init__(on_message, algorithm, queue_size, None, replay_count, group_key=group_key,
+                         clients=ClientRegistry(worker_index + 1, workers), ticket_key=ticket_key,
+                         flood_guard=flood_guard, files=files)
+        self.link = None  # StreamWriter to the sequencer
+
+    def broadcast(self, message, _client=None, channel=None):
+        origin = _client.id if _client is not None else 0
+        cid = channel.id if channel is not None else LOBBY_ID
+        self.link.write(encode_frame(LINK_PUBLISH, CLIENT_CHANNEL.pack(origin, cid) + message.encode('utf-8')))
+
+    def subscribe(self, client, channel, after=None):
+        # The client is subscribed once its replay comes back through the
+        # sequencer's stream, so it sees exactly the messages published after it.
+        if after is not None:
+            self.link.write(encode_frame(LINK_RESUME, HISTORY_LOOKUP.pack(client.id, channel.id, after,
+                                                                          MAX_HISTORY_BATCH, client.codec)))
+        else:
+            self.link.write(encode_frame(LINK_JOIN, JOIN_REQUEST.pack(client.id, channel.id, self.replay_count,
+                                                                      client.codec)))
+
+    def request_history(self, client, after, count, channel):
+        self.link.write(encode_frame(LINK_HISTORY, HISTORY_LOOKUP.pack(client.id, channel.id, after, count,
+                                                                       client.codec)))
+
+    def handle_link_frame(self, msg_type, payload):
+        if msg_type == LINK_DELIVER:
+            cid, = CHANNEL.unpack_from(payload)
+            channel = self.channels.get(cid)
+            if channel is None:
+                return  # nobody here ever joined it
+            with self._publish_lock:
+                channel.record()
+                frames = FrameVariants(None, zip(DELIVER_CODECS, split_frames(payload[CHANNEL.size:])))
+                evict = self.fan_out(frames, channel)
+            self.evict(evict)
+            return
+        if msg_type == LINK_REPLAY:
+            client_id, cid = CLIENT_CHANNEL.unpack_from(payload)
+            frame = payload[CLIENT_CHANNEL.size:]
+        else:
+            client_id, = CLIENT_ID.unpack_from(payload)
+            frame = payload[CLIENT_ID.size:]
+        client = self.clients.get(client_id)
+        if client is None:
+            return  # gone in the meantime
+        if msg_type == LINK_REPLAY:
+            with self._publish_lock:
+                if frame:
+                    client.send(frame)
+                channel = client.channels.get(cid)
+                if channel is not None:  # still wanted
+                    channel.subscribers.add(client)
+        elif msg_type == LINK_SEND:
+            client.send(frame)
+
+
+def split_frames(data):
+    frames = []
+    offset = 0
+    while offset < len(data):
+        length, _ = HEADER.unpack_from(data, offset)
+        frames.append(data[offset:offset + HEADER_SIZE + length])
+        offset += HEADER_SIZE + length
+    return frames
+
+
+def display(message):
+    log.info("%s", message)
+
+
+async def run_worker(index, args, group_key, ticket_key, link_path):
+    hub = WorkerHub(display, ALGORITHM_NAMES[args.cipher], args.queue_size, group_key, ticket_key, index,
+                    args.workers, args.replay, flood_guard_from_args(args, args.workers),
+                    FileSpool(os.path.join(os.path.dirname(link_path), "files")))
+    reader, hub.link = await asyncio.open_unix_connection(link_path)
+    server = AsyncChatServer(args.host, args.port, display, stats_interval=args.stats_interval,
+                             queue_size=args.queue_size, overflow_policy=args.overflow_policy,
+                             flush_window=args.coalesce / 1000,
+                             metrics_port=args.metrics_port + index if args.metrics_port else None,
+                             reuse_port=True, hub=hub)
+
+    async def read_link():
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                break
+            for msg_type, payload in decoder.feed(data):
+                hub.handle_link_frame(msg_type, payload)
+        log.warning("Worker %d lost the sequencer, stopping", index)
+        if server.stop_event is not None:
+            server.stop_event.set()
+
+    link_task = asyncio.create_task(read_link())
+    try:
+        await server.serve_forever()
+    finally:
+        link_task.cancel()
+        hub.link.close()
+
+
+def worker_main(index, args, group_key, ticket_key, link_path):
+    logging.basicConfig(level=args.log_level.upper(),
+                        format=f"%(asctime)s %(levelname)s [worker {index}] %(message)s")
+    raise_fd_limit()
+    try:
+        import uvloop  # optional, faster event loop
+        uvloop.install()
+    except ImportError:
+        pass
+    try:
+        asyncio.run(run_worker(index, args, group_key, ticket_key, link_path))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_master(args):
+    group_key = new_key()
+    ticket_key = new_key()  # shared, so a client can resume on whichever worker accepts it
+    sequencer = Sequencer(group_key, ALGORITHM_NAMES[args.cipher], args.history)
+    link_dir = tempfile.mkdtemp(prefix="lesnet-")
+    link_path = os.path.join(link_dir, "sequencer.sock")
+    os.mkdir(os.path.join(link_dir, "files"))  # the workers' shared FileSpool, removed with link_dir
+    link_server = await asyncio.start_unix_server(sequencer.handle_worker, link_path)
+
+    context = multiprocessing.get_context("spawn")  # never fork a process that already runs threads
+    workers = [context.Process(target=worker_main, args=(index, args, group_key, ticket_key, link_path),
+                                       name=f"lesnet-worker-{index}", daemon=True)
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    log.info("Cluster of %d workers on %s:%d", args.workers, args.host, args.port)
+    responder = None
+    if not args.no_discovery:
+        try:
+            responder = DiscoveryResponder(args.port).start()  # one answer per host, not per worker
+        except OSError as e:
+            log.warning("Discovery unavailable: %s", e)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), args.stats_interval)
+            except asyncio.TimeoutError:
+                alive = sum(worker.is_alive() for worker in workers)
+                log.info("Sequencer: %s | %d/%d workers alive", sequencer.summary(), alive, len(workers))
+    finally:
+        if responder is not None:
+            responder.stop()
+        # Workers notify their clients before the sequencer goes away.
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+        await loop.run_in_executor(None, lambda: [worker.join(10) for worker in workers])
+        link_server.close()
+        await link_server.wait_closed()
+        sequencer.close()
+        shutil.rmtree(link_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-process LesNETchat server (Linux)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=BROADCAST_PORT)
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--queue-size", type=int, default=SEND_QUEUE_SIZE, help="outbound frames buffered per client")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default=DROP_OLDEST)
+    parser.add_argument("--coalesce", type=float, nargs="?", const=FLUSH_WINDOW * 1000, default=0, metavar="MS",
+                        help=f"batch outbound frames for up to MS milliseconds (default {FLUSH_WINDOW * 1000:g} when given)")
+    parser.add_argument("--history", default=HISTORY_FILE, help="SQLite history file, empty to disable")
+    parser.add_argument("--replay", type=int, default=REPLAY_COUNT, help="messages replayed to joining clients")
+    parser.add_argument("--cipher", choices=sorted(ALGORITHM_NAMES), default="aes-gcm")
+    parser.add_argument("--stats-interval", type=float, default=60, help="seconds between stats logs")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="worker N serves its metrics on this port + N, 0 to disable")
+    parser.add_argument("--no-discovery", action="store_true", help="do not answer LAN discovery probes")
+    add_rate_limit_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s [master] %(message)s")
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        parser.error("cluster mode needs SO_REUSEPORT and Unix sockets (Linux); use async_server.py instead")
+    try:
+        asyncio.run(run_master(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import socket
+import threading
+import time
+from payload_codec import UNPREFIXED
+from send_queue import SendQueue, DROP_OLDEST, SEND_QUEUE_SIZE
+
+IOV_MAX = 1024  # buffers per sendmsg() call
+KEEPALIVE_IDLE = 30  # seconds of silence before the kernel starts probing
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def configure_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    # TCP keepalive lets the kernel notice a peer that vanished without a
+    # FIN (sleeping laptop, dropped Wi-Fi) even while we have nothing to send.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):  # Linux
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    if hasattr(socket, "SIO_KEEPALIVE_VALS") and hasattr(sock, "ioctl"):
+        # Windows; asyncio hands out TransportSockets, which have no ioctl()
+        # and rely on the TCP_KEEP* options above (Windows 10+).
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+
+
+def send_frames(sock, frames):
+    # Vectored write of a batch of frames: one sendmsg() per IOV_MAX frames
+    # instead of copying them into a single buffer first.
+    if len(frames) == 1 or not hasattr(sock, "sendmsg"):
+        sock.sendall(frames[0] if len(frames) == 1 else b"".join(frames))
+        return
+    views = [memoryview(frame) for frame in frames]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        while sent:
+            size = len(views[index])
+            if sent < size:
+                views[index] = views[index][sent:]  # partial write, resume mid-frame
+                break
+            sent -= size
+            index += 1
+
+
+class BaseConnection:
+    # Per-connection metadata shared by the threaded and asyncio servers.
+    def __init__(self, client_id, addr, queue):
+        self.id = client_id
+        self.addr = addr
+        self.queue = queue
+        self.nickname = None
+        self.uplink = None  # SessionCipher for messages from this client, set by the handshake
+        self.joined = False  # WELCOME has been sent
+        self.channels = {}  # channel id -> Channel this client asked to be in
+        self.connected_at = time.time()
+        self.accepted_at = time.monotonic()  # the handshake deadline counts from here
+        self.last_seen = time.monotonic()  # last frame received, for the idle reaper
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+        self.metrics = None  # ServerMetrics, set by the hub
+        self.limits = None  # rate_limit.ClientLimits, set by the hub
+        self.codec = UNPREFIXED  # payload_codec codec negotiated in the handshake
+        self.uploads = {}    # transfer id -> transfers.Upload being received
+        self.downloads = {}  # transfer id -> transfers.Download being streamed
+        self._turn = 0       # round robin over downloads
+
+    def record_sent(self, nbytes, queued_at=None):
+        # queued_at is the perf_counter() time the oldest frame was queued.
+        self.bytes_out += nbytes
+        if self.metrics is not None:
+            self.metrics.writes.inc()
+            self.metrics.bytes_out.inc(nbytes)
+            if queued_at is not None:
+                self.metrics.send_latency.observe(time.perf_counter() - queued_at)
+
+    def record_file_sent(self, nbytes):
+        self.record_sent(nbytes)
+        if self.metrics is not None:
+            self.metrics.file_bytes_out.inc(nbytes)
+
+    def wake(self):
+        self.queue.wake()
+
+    def next_download(self):
+        # (download, (spool offset, length)) for the writer's next file
+        # frame, taking turns between downloads; None if none has credit.
+        # Finished downloads are dropped here. Writer side only.
+        downloads = list(self.downloads.values())
+        for turn in range(len(downloads)):
+            download = downloads[(self._turn + turn) % len(downloads)]
+            if download.done:
+                self.downloads.pop(download.id, None)
+                download.close()
+                continue
+            span = download.next_span()
+            if span is not None:
+                self._turn += turn + 1
+                return download, span
+        return None
+
+    def close_transfers(self):
+        for transfer in list(self.uploads.values()) + list(self.downloads.values()):
+            transfer.close()
+        self.uploads.clear()
+        self.downloads.clear()
+
+    @property
+    def name(self):
+        return self.nickname or f"{self.addr[0]}:{self.addr[1]}"
+
+    def info(self):
+        return {
+            "id": self.id,
+            "nickname": self.nickname,
+            "address": f"{self.addr[0]}:{self.addr[1]}",
+            "connected_at": self.connected_at,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "idle": round(time.monotonic() - self.last_seen, 1),
+            "queue_depth": len(self.queue),
+            "dropped": self.queue.dropped,
+            "codec": self.codec,
+            "uploads": len(self.uploads),
+            "downloads": len(self.downloads),
+            "throttled": self.limits.throttled if self.limits is not None else 0,
+        }
+
+
+class ClientConnection(BaseConnection):
+    # One accepted socket in the threaded server. Broadcasts only enqueue
+    # frames; a dedicated writer thread does the blocking sendall, so a client
+    # with a full TCP window only ever stalls itself. File downloads share the
+    # writer at a lower priority: one frame at a time, only while nothing
+    # else is queued, so a chat line waits for at most one chunk.
+    def __init__(self, client_id, sock, addr, queue_size=SEND_QUEUE_SIZE, policy=DROP_OLDEST, flush_window=0.0):
+        super().__init__(client_id, addr, SendQueue(queue_size, policy, flush_window=flush_window))
+        self.sock = sock
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+
+    def start(self):
+        self.writer.start()
+
+    def send(self, frame):
+        # False means the overflow policy wants this client evicted.
+        return self.queue.put(frame)
+
+    def _write_loop(self):
+        try:
+            while True:
+                bulk = self.next_download()
+                frames = self.queue.get(0 if bulk else None)
+                if frames:
+                    send_frames(self.sock, frames)
+                    self.record_sent(sum(len(frame) for frame in frames), self.queue.batch_started)
+                elif self.queue.closed:
+                    break
+                elif bulk:
+                    download, (offset, count) = bulk
+                    self.sock.sendfile(download.file, offset, count)  # os.sendfile, or send() on Windows
+                    download.sent(count)
+                    self.record_file_sent(count)
+        except OSError:
+            self.close(flush=False)
+            return
+        finally:
+            self.close_transfers()
+        self.sock.close()
+
+    def close(self, flush=True):
+        # flush=True lets the writer send what is already queued first.
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        if not flush:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
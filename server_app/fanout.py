@@ -0,0 +1,30 @@
+import threading
+
+
+class BroadcastStats:
+    # Running timings for broadcast(): the one encrypt + frame encode per
+    # message, and handing that same frame to every recipient.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.recipients = 0
+        self.encode_time = 0.0
+        self.fanout_time = 0.0
+        self.last = (0, 0.0, 0.0)
+
+    def record(self, recipients, encode_time, fanout_time):
+        with self._lock:
+            self.count += 1
+            self.recipients += recipients
+            self.encode_time += encode_time
+            self.fanout_time += fanout_time
+            self.last = (recipients, encode_time, fanout_time)
+
+    def summary(self):
+        with self._lock:
+            if not self.count:
+                return "Broadcasts: 0"
+            recipients, encode_time, fanout_time = self.last
+            return (f"Broadcasts: {self.count} | last: {recipients} clients, "
+                    f"encrypt {encode_time * 1e6:.0f} us, fan-out {fanout_time * 1e6:.0f} us | "
+                    f"avg fan-out {self.fanout_time / self.count * 1e6:.0f} us")
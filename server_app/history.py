@@ -0,0 +1,125 @@
+import collections
+import sqlite3
+import threading
+import time
+from protocol import LOBBY_ID
+
+HISTORY_FILE = "chat_history.db"
+REPLAY_COUNT = 50
+TAIL_SIZE = 512
+COMMIT_INTERVAL = 0.05  # seconds
+
+
+def channel_table(channel_id):
+    return "messages" if channel_id == LOBBY_ID else f"channel_{channel_id:08x}"
+
+
+class HistoryStore:
+    # Append-only chat history in SQLite (WAL mode), indexed by sequence
+    # number (the primary key) and timestamp. append() assigns the next
+    # sequence number and queues the row; a writer thread commits queued rows
+    # in batches, so the broadcast path never waits on the disk. The newest
+    # TAIL_SIZE rows are also kept in memory, which covers replay-on-join and
+    # most "since seq X" queries without touching SQLite at all. Each
+    # channel keeps its own numbering in its own table of the same file.
+    def __init__(self, path=HISTORY_FILE, tail_size=TAIL_SIZE, commit_interval=COMMIT_INTERVAL, table="messages"):
+        self.path = path
+        self.table = table
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._pending = []
+        self._closed = False
+
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.execute("PRAGMA journal_mode=WAL")
+        self._reader.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                             "seq INTEGER PRIMARY KEY, ts REAL NOT NULL, body TEXT NOT NULL)")
+        self._reader.execute(f"CREATE INDEX IF NOT EXISTS {table}_ts ON {table} (ts)")
+        self._reader.commit()
+        last = self._reader.execute(f"SELECT seq, ts, body FROM {table} ORDER BY seq DESC LIMIT ?",
+                                    (tail_size,)).fetchall()
+        self._tail = collections.deque(reversed(last), maxlen=tail_size)
+        self.last_seq = last[0][0] if last else 0
+        self.committed_seq = self.last_seq
+
+        self._writer = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def append(self, body, seq=None, ts=None):
+        # Returns (seq, ts). Pass seq to store a number assigned elsewhere.
+        with self._lock:
+            seq = seq if seq is not None else self.last_seq + 1
+            ts = ts if ts is not None else time.time()
+            record = (seq, ts, body)
+            self.last_seq = seq
+            self._tail.append(record)
+            self._pending.append(record)
+            if len(self._pending) == 1:
+                self._cond.notify()
+            return seq, ts
+
+    def last(self, count=REPLAY_COUNT):
+        with self._lock:
+            if count <= len(self._tail) or len(self._tail) < self._tail.maxlen:
+                return list(self._tail)[-count:] if count else []
+        return self.since(max(self.last_seq - count, 0), count)
+
+    def since(self, seq, limit=1000):
+        # Messages with a sequence number greater than seq, oldest first.
+        with self._lock:
+            if self._tail and self._tail[0][0] <= seq + 1:
+                return [record for record in self._tail if record[0] > seq][:limit]
+            # Rows older than the tail must be on disk before we query them.
+            while self._tail and self.committed_seq < self._tail[0][0] - 1 and not self._closed:
+                self._committed.wait(1)
+            tail = list(self._tail)
+        rows = self._query(f"SELECT seq, ts, body FROM {self.table} WHERE seq > ? ORDER BY seq LIMIT ?",
+                           (seq, limit))
+        if len(rows) < limit:
+            newest = rows[-1][0] if rows else seq
+            rows.extend(record for record in tail if record[0] > newest)
+        return rows[:limit]
+
+    def recent(self, seq):
+        # Like since(), but only what is in memory: never waits for SQLite.
+        with self._lock:
+            return [record for record in self._tail if record[0] > seq]
+
+    def between(self, start_ts, end_ts, limit=1000):
+        return self._query(f"SELECT seq, ts, body FROM {self.table} WHERE ts >= ? AND ts < ? ORDER BY seq LIMIT ?",
+                           (start_ts, end_ts, limit))
+
+    def _query(self, sql, params):
+        with self._read_lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    def _run(self):
+        writer = sqlite3.connect(self.path)
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._closed:
+                    self._cond.wait(self.commit_interval)  # let a batch build up
+                rows, self._pending = self._pending, []
+                closed = self._closed
+            if rows:
+                writer.executemany(f"INSERT OR REPLACE INTO {self.table} (seq, ts, body) VALUES (?, ?, ?)", rows)
+                writer.commit()
+                with self._lock:
+                    self.committed_seq = rows[-1][0]
+                    self._committed.notify_all()
+            if closed:
+                break
+        writer.close()
+
+    def close(self, timeout=5):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join(timeout)
+        with self._read_lock:
+            self._reader.close()
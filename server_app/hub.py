@@ -0,0 +1,569 @@
+import logging
+import os
+import struct
+import threading
+import time
+from channels import Channel, MAX_CHANNELS, MAX_SUBSCRIPTIONS
+from fanout import BroadcastStats
+from history import HistoryStore, REPLAY_COUNT, channel_table
+from metrics import ServerMetrics
+from payload_codec import CodecError, decode_payload, encode_payload, negotiate, UNPREFIXED
+from protocol import (encode_frame, pack_history, channel_id, HEADER_SIZE, MSG_HELLO, MSG_CHAT, MSG_WELCOME,
+                      MSG_HISTORY, MSG_HISTORY_REQUEST, MSG_RESUME, MSG_PING, MSG_PONG, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE,
+                      MSG_CHANNEL_CHAT, MSG_CHANNEL_HISTORY, MSG_UPLOAD, MSG_UPLOAD_CHUNK, MSG_DOWNLOAD,
+                      MSG_FILE_CHUNK, MSG_TRANSFER_ACK, SERVER_HELLO, WELCOME, HISTORY_REQUEST, RESUME, PING,
+                      CHAT_HEADER, NOTICE_SEQ, CHANNEL, SUBSCRIBE, LOBBY, LOBBY_ID, MAX_CHANNEL_NAME, TRANSFER, CHUNK,
+                      CREDIT)
+from rate_limit import FloodGuard, ADMIT, DISCONNECT
+from registry import ClientRegistry
+from session_crypto import (AES_GCM, InvalidTag, KeyExchange, SessionCipher, new_key, resume_key, PUBLIC_KEY_SIZE,
+                            RESUME_NONCE_SIZE)
+from send_queue import SEND_QUEUE_SIZE
+from timer_wheel import TimerWheel
+from transfers import FileSpool, TransferError, MAX_DOWNLOADS, MAX_UPLOADS
+
+log = logging.getLogger("lesnet.server")
+
+MAX_HISTORY_BATCH = 1000
+TICKET = struct.Struct("!dB")  # expiry time, payload codec, followed by the uplink key
+TICKET_LIFETIME = 3600  # seconds
+# Heartbeats: a client we have not heard from for PING_INTERVAL gets a PING;
+# one that stays silent for IDLE_TIMEOUT (or never finishes the handshake
+# within HANDSHAKE_TIMEOUT) is closed.
+PING_INTERVAL = 15
+IDLE_TIMEOUT = 45
+HANDSHAKE_TIMEOUT = 10
+REAP_TICK = 1.0
+SLOW_DOWN = "You are sending too fast; your messages are being dropped."
+# Paced by their own credit window instead of the rate limiter
+TRANSFER_FRAMES = (MSG_UPLOAD_CHUNK, MSG_TRANSFER_ACK)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def chat_frame(group, seq, ts, origin, body, codec=UNPREFIXED, channel=LOBBY_ID):
+    header = CHAT_HEADER.pack(seq, ts, origin)
+    if channel == LOBBY_ID:
+        return encode_frame(MSG_CHAT, header + group.encrypt(encode_payload(codec, body), header))
+    header = CHANNEL.pack(channel) + header
+    return encode_frame(MSG_CHANNEL_CHAT, header + group.encrypt(encode_payload(codec, body), header))
+
+
+def history_frame(group, records, codec=UNPREFIXED, channel=LOBBY_ID):
+    # One batched frame for a whole replay; empty for no records.
+    if not records:
+        return b""
+    plain = encode_payload(codec, pack_history(records))
+    if channel == LOBBY_ID:
+        return encode_frame(MSG_HISTORY, group.encrypt(plain))
+    prefix = CHANNEL.pack(channel)
+    return encode_frame(MSG_CHANNEL_HISTORY, prefix + group.encrypt(plain, prefix))
+
+
+class FrameVariants(dict):
+    # codec -> the same message framed for clients using that codec. Each
+    # variant is compressed and encrypted once, when the first client that
+    # needs it comes up; `seconds` adds up the time spent doing that.
+    def __init__(self, build, frames=()):
+        super().__init__(frames)
+        self.build = build
+        self.seconds = 0.0
+
+    def __missing__(self, codec):
+        started = time.perf_counter()
+        frame = self[codec] = self.build(codec)
+        self.seconds += time.perf_counter() - started
+        return frame
+
+
+class ChatHub:
+    # Everything the threaded ChatServer and the AsyncChatServer have in
+    # common: the session handshake, decrypt -> broadcast -> display, and the
+    # client registry. Transports feed it decoded frames and give it
+    # connections with send()/close(); it never blocks on a socket.
+    def __init__(self, on_message, algorithm=AES_GCM, queue_size=SEND_QUEUE_SIZE, history=None,
+                 replay_count=REPLAY_COUNT, group_key=None, clients=None, ticket_key=None, flood_guard=None,
+                 files=None):
+        self.on_message = on_message
+        self.queue_size = queue_size
+        self.history = history  # HistoryStore for the lobby, or None to keep no history
+        self.replay_count = replay_count
+        # Held while a message is stored and queued to a channel, while a
+        # subscriber gets its replay and while subscriptions change, so
+        # nobody sees a message twice or misses one in between. Never held
+        # across a socket write.
+        self._publish_lock = threading.Lock()
+        self.lobby = Channel(LOBBY_ID, LOBBY, history)
+        self.channels = {LOBBY_ID: self.lobby}
+        self.clients = clients if clients is not None else ClientRegistry()
+        self.broadcast_stats = BroadcastStats()
+        self.metrics = ServerMetrics(self.clients)
+        self.metrics.gauge("chat_channels", "Channels with a subscriber index", lambda: len(self.channels))
+        self.metrics.gauge_family("chat_channel_subscribers", "Connections subscribed to a channel",
+                                  lambda: [({"channel": c.name}, len(c.subscribers)) for c in self.channel_list()])
+        self.metrics.gauge_family("chat_channel_messages_per_second", "Recent message rate of a channel",
+                                  lambda: [({"channel": c.name}, round(c.rate.per_second(), 3))
+                                           for c in self.channel_list()])
+        self.evicted = 0
+        self.idle_timers = TimerWheel(REAP_TICK)  # one lazily renewed timer per connection
+        self.flood_guard = flood_guard or FloodGuard()  # token buckets, see rate_limit.py
+        self.files = files or FileSpool()  # uploaded files, see transfers.py
+        self.loop = None  # set by the asyncio transport; history reads then run off the loop
+
+        self.key_exchange = KeyExchange()
+        self.group = SessionCipher(group_key or new_key(), algorithm)  # shared broadcast key
+        # Resumption tickets are sealed with a key only the server knows, so
+        # it keeps no per-session state; a restart simply invalidates them.
+        self.tickets = SessionCipher(ticket_key or new_key(), algorithm)
+        self.hello_frame = encode_frame(
+            MSG_HELLO, SERVER_HELLO.pack(algorithm) + self.key_exchange.public_bytes)
+
+    def open(self, client):
+        client.metrics = self.metrics
+        self.metrics.accepted.inc()
+        self.flood_guard.attach(client)
+        self.clients.add(client)
+        self.idle_timers.schedule(client, HANDSHAKE_TIMEOUT)
+        client.send(self.hello_frame)
+
+    def handle_frame(self, client, msg_type, payload):
+        # Raises ProtocolError (or InvalidTag/UnicodeDecodeError) for a
+        # misbehaving client; the transport should then drop it.
+        client.bytes_in += HEADER_SIZE + len(payload)
+        client.last_seen = time.monotonic()
+        self.metrics.bytes_in.inc(HEADER_SIZE + len(payload))
+        if client.uplink is None and msg_type not in (MSG_HELLO, MSG_RESUME):
+            # Nothing is answered, or worth a reply, before the handshake.
+            raise ProtocolError("Frame before handshake")
+        if client.uplink is not None and msg_type not in TRANSFER_FRAMES:
+            # Rate limits apply before any decrypt or fan-out work is done.
+            chat = msg_type in (MSG_CHAT, MSG_CHANNEL_CHAT)
+            verdict = self.flood_guard.check(client, HEADER_SIZE + len(payload), chat)
+            if verdict != ADMIT:
+                self.throttle(client, verdict, HEADER_SIZE + len(payload))
+                return
+        if msg_type == MSG_CHAT:
+            self.receive_chat(client, LOBBY_ID, payload)
+        elif msg_type == MSG_CHANNEL_CHAT:
+            if len(payload) < CHANNEL.size:
+                raise ProtocolError("Bad channel message")
+            channel, = CHANNEL.unpack_from(payload)
+            self.receive_chat(client, channel, payload[CHANNEL.size:], payload[:CHANNEL.size])
+        elif msg_type == MSG_HELLO:
+            if client.uplink is not None or len(payload) < PUBLIC_KEY_SIZE:
+                raise ProtocolError("Unexpected hello")
+            client.uplink = SessionCipher(self.key_exchange.derive(payload[:PUBLIC_KEY_SIZE]), self.group.algorithm)
+            if len(payload) > PUBLIC_KEY_SIZE:
+                client.codec = negotiate(payload[PUBLIC_KEY_SIZE:])  # the codecs the client can decode
+            self.join(client)
+        elif msg_type == MSG_RESUME:
+            if client.uplink is not None or len(payload) <= RESUME.size:
+                raise ProtocolError("Unexpected resume")
+            after, nonce = RESUME.unpack_from(payload)
+            key, client.codec = self.open_ticket(payload[RESUME.size:])
+            server_nonce = os.urandom(RESUME_NONCE_SIZE)
+            client.uplink = SessionCipher(resume_key(key, nonce, server_nonce), self.group.algorithm)
+            self.metrics.resumed.inc()
+            self.join(client, after, server_nonce)
+        elif msg_type == MSG_HISTORY_REQUEST:
+            if client.uplink is None or len(payload) not in (HISTORY_REQUEST.size, HISTORY_REQUEST.size + CHANNEL.size):
+                raise ProtocolError("Bad history request")
+            after, count = HISTORY_REQUEST.unpack_from(payload)
+            channel = LOBBY_ID
+            if len(payload) > HISTORY_REQUEST.size:
+                channel, = CHANNEL.unpack_from(payload, HISTORY_REQUEST.size)
+            if channel in client.channels:
+                self.request_history(client, after, min(count, MAX_HISTORY_BATCH), client.channels[channel])
+        elif msg_type == MSG_SUBSCRIBE:
+            if client.uplink is None or len(payload) <= SUBSCRIBE.size:
+                raise ProtocolError("Bad subscribe")
+            after, = SUBSCRIBE.unpack_from(payload)
+            self.join_channel(client, payload[SUBSCRIBE.size:].decode('utf-8'), after)
+        elif msg_type == MSG_UNSUBSCRIBE:
+            if client.uplink is None:
+                raise ProtocolError("Unsubscribe before handshake")
+            channel = client.channels.pop(channel_id(payload.decode('utf-8')), None)
+            if channel is not None:
+                with self._publish_lock:
+                    channel.subscribers.discard(client)
+        elif msg_type == MSG_UPLOAD:
+            if client.uplink is None or len(payload) != TRANSFER.size:
+                raise ProtocolError("Bad upload")
+            self.start_upload(client, *TRANSFER.unpack(payload))
+        elif msg_type == MSG_UPLOAD_CHUNK:
+            if client.uplink is None or len(payload) <= CHUNK.size:
+                raise ProtocolError("Bad file chunk")
+            self.receive_chunk(client, payload)
+        elif msg_type == MSG_DOWNLOAD:
+            if client.uplink is None or len(payload) != CREDIT.size:
+                raise ProtocolError("Bad download")
+            self.start_download(client, *CREDIT.unpack(payload))
+        elif msg_type == MSG_TRANSFER_ACK:
+            if len(payload) != CREDIT.size:
+                raise ProtocolError("Bad transfer ack")
+            transfer_id, _, limit = CREDIT.unpack(payload)
+            download = client.downloads.get(transfer_id)
+            if download is not None:
+                download.credit(limit)
+                client.wake()
+        elif msg_type == MSG_PING:
+            client.send(encode_frame(MSG_PONG, payload[:PING.size]))
+        elif msg_type == MSG_PONG:
+            if len(payload) == PING.size:
+                sent_ns, = PING.unpack(payload)
+                self.metrics.ping_rtt.observe((time.monotonic_ns() - sent_ns) / 1e9)
+
+    def receive_chat(self, client, channel_id, ciphertext, aad=None):
+        if client.uplink is None:
+            raise ProtocolError("Chat message before handshake")
+        started = time.perf_counter()
+        try:
+            message = decode_payload(client.codec, client.uplink.decrypt(ciphertext, aad)).decode('utf-8')
+        except CodecError as e:
+            raise ProtocolError(f"Bad chat payload: {e}")
+        self.metrics.decrypt_seconds.observe(time.perf_counter() - started)
+        channel = client.channels.get(channel_id)
+        if channel is None:
+            return  # left the channel while the message was on its way
+        self.metrics.messages.inc()
+        self.update_nickname(client, message)
+        self.broadcast(message, client, channel)
+        self.on_message(message if channel is self.lobby else f"[{channel.name}] {message}")
+
+    def throttle(self, client, verdict, nbytes):
+        # The frame is dropped. The sender hears about it once per streak;
+        # one that keeps going regardless is disconnected.
+        self.metrics.throttled.inc()
+        self.metrics.throttled_bytes.inc(nbytes)
+        if verdict == DISCONNECT:
+            self.metrics.flooders.inc()
+            log.warning("Disconnecting %s for flooding (%d frames dropped)", client.name, client.limits.throttled)
+            raise ProtocolError("Flooding")
+        if not client.limits.warned:
+            client.limits.warned = True
+            self.notice(client, SLOW_DOWN)
+
+    def notice(self, client, text):
+        client.send(chat_frame(self.group, NOTICE_SEQ, time.time(), 0, text.encode('utf-8'), client.codec))
+
+    def start_upload(self, client, transfer_id, size, token):
+        # New or resumed; the ACK tells the uploader where to go on from,
+        # which is the end for a file the server has already.
+        upload = client.uploads.get(transfer_id)
+        if upload is None:
+            if len(client.uploads) >= MAX_UPLOADS:
+                return self.refuse(client, transfer_id, f"You can send at most {MAX_UPLOADS} files at once.")
+            try:
+                upload = self.files.open_upload(transfer_id, size, token, self.group)
+            except TransferError as e:
+                return self.refuse(client, transfer_id, str(e))
+            except OSError as e:
+                log.warning("Cannot spool an upload from %s: %s", client.name, e)
+                return self.refuse(client, transfer_id, "The server cannot store files right now.")
+            self.metrics.file_offers.inc()
+            if upload.done:
+                self.metrics.file_dedup_hits.inc()
+                self.metrics.file_bytes_saved.inc(size)
+            else:
+                client.uploads[transfer_id] = upload
+        client.send(encode_frame(MSG_TRANSFER_ACK, CREDIT.pack(transfer_id, upload.offset, upload.grant())))
+
+    def receive_chunk(self, client, payload):
+        # Decrypt with the uploader's key, encrypt once with the broadcast
+        # key and store the finished download frame. Runs on the client's
+        # reader (the event loop for asyncio), one CHUNK_SIZE write at a time.
+        # Chunks are exempt from the rate limits because the credit in our
+        # ACKs paces them, so one past that credit ends the connection.
+        header = payload[:CHUNK.size]
+        transfer_id, offset = CHUNK.unpack(header)
+        upload = client.uploads.get(transfer_id)
+        if upload is None or offset != upload.offset:
+            raise ProtocolError("Unexpected file chunk")
+        if offset + upload.chunk_size() > upload.granted:
+            raise ProtocolError("File chunk past the credit window")
+        chunk = client.uplink.decrypt(payload[CHUNK.size:], header)
+        if len(chunk) != upload.chunk_size():
+            raise ProtocolError("Bad file chunk size")
+        try:
+            upload.append(encode_frame(MSG_FILE_CHUNK, header + self.group.encrypt(chunk, header)), chunk)
+        except TransferError as e:
+            client.uploads.pop(transfer_id)
+            return self.refuse(client, transfer_id, str(e))
+        except OSError as e:
+            log.warning("Cannot spool an upload from %s: %s", client.name, e)
+            client.uploads.pop(transfer_id).close()
+            return self.refuse(client, transfer_id, "The server cannot store files right now.")
+        self.metrics.file_bytes_in.inc(len(chunk))
+        if upload.done:
+            client.uploads.pop(transfer_id)
+            self.metrics.files.inc()
+            log.info("%s uploaded a file of %d bytes", client.name, upload.size)
+        client.send(encode_frame(MSG_TRANSFER_ACK, CREDIT.pack(transfer_id, upload.offset, upload.grant())))
+
+    def start_download(self, client, transfer_id, offset, limit):
+        # The connection's writer streams it from the spool from now on.
+        download = client.downloads.get(transfer_id)
+        if download is not None:
+            download.credit(limit)  # asked again after a lost ACK
+        elif len(client.downloads) >= MAX_DOWNLOADS:
+            return self.refuse(client, transfer_id, f"You can download at most {MAX_DOWNLOADS} files at once.")
+        else:
+            download = self.files.open_download(transfer_id, offset, limit)
+            if download is None:
+                return self.refuse(client, transfer_id, "That file is not on this server (any more).")
+            if client.closed:
+                return download.close()
+            client.downloads[transfer_id] = download
+        client.wake()
+
+    def refuse(self, client, transfer_id, reason):
+        self.notice(client, reason)
+        client.send(encode_frame(MSG_TRANSFER_ACK, CREDIT.pack(transfer_id, 0, 0)))
+
+    def join(self, client, after=None, server_nonce=b""):
+        # WELCOME, then the lobby. A resumed session gets everything after
+        # the last sequence number it saw instead of the usual replay; the
+        # client subscribes to its other channels again itself.
+        client.send(self.welcome_frame(client, server_nonce))
+        client.channels[LOBBY_ID] = self.lobby
+        self.subscribe(client, self.lobby, after)
+        client.joined = True
+
+    def join_channel(self, client, name, after=0):
+        name = name.strip()
+        if not name or len(name.encode('utf-8')) > MAX_CHANNEL_NAME:
+            return self.notice(client, f"Room names are 1 to {MAX_CHANNEL_NAME} bytes long.")
+        if channel_id(name) in client.channels:
+            return
+        if len(client.channels) >= MAX_SUBSCRIPTIONS:
+            return self.notice(client, f"You can be in at most {MAX_SUBSCRIPTIONS} rooms at once.")
+        channel = self.channel(name)
+        if channel is None:
+            return self.notice(client, f"Cannot open room {name!r} on this server.")
+        client.channels[channel.id] = channel
+        self.subscribe(client, channel, after or None)
+
+    def channel(self, name):
+        # The channel called `name`, created on first use. None when the
+        # server has MAX_CHANNELS already or another name has the same id.
+        cid = channel_id(name)
+        with self._publish_lock:
+            channel = self.channels.get(cid)
+            if channel is None:
+                if len(self.channels) >= MAX_CHANNELS:
+                    return None
+                history = None
+                if self.history is not None:
+                    history = HistoryStore(self.history.path, table=channel_table(cid))
+                channel = self.channels[cid] = Channel(cid, name, history)
+        return channel if channel.name == name else None
+
+    def channel_list(self):
+        with self._publish_lock:
+            return list(self.channels.values())
+
+    def subscribe(self, client, channel, after=None):
+        # The replay, then live broadcasts, with nothing published in between.
+        # The replay is read without _publish_lock (see defer()), which would
+        # hold up every broadcast behind SQLite; what was published meanwhile
+        # is sent from the history's in-memory tail once the lock is back.
+        history = channel.history
+        if history is None or (after is None and not self.replay_count):
+            with self._publish_lock:
+                channel.subscribers.add(client)
+            return
+        with self._publish_lock:
+            upto = channel.last_seq
+        if after is not None:
+            read = lambda: history.since(after, MAX_HISTORY_BATCH)
+        else:
+            read = lambda: history.last(self.replay_count)
+        self.defer(read, lambda records: self._finish_subscribe(client, channel, upto, records))
+
+    def _finish_subscribe(self, client, channel, upto, records):
+        with self._publish_lock:
+            if client.closed or client.channels.get(channel.id) is not channel:
+                return  # gone, or left the channel during the read
+            newest = max(upto, records[-1][0] if records else 0)
+            records = records + channel.history.recent(newest)  # a gap left here is fetched by the client
+            self.send_history(client, records, channel)
+            channel.subscribers.add(client)  # only now will broadcasts include this client
+
+    def defer(self, read, then):
+        # Runs a history read and hands the records to then(). The threaded
+        # server reads right here, on the client's own reader thread; the
+        # asyncio server reads in the default executor and calls then() back
+        # on the loop, so a slow SQLite query stalls nobody else.
+        if self.loop is None:
+            return then(read())
+
+        def done(future):
+            try:
+                records = future.result()
+            except Exception as e:
+                log.warning("History read failed: %r", e)
+                records = []
+            then(records)
+
+        self.loop.run_in_executor(None, read).add_done_callback(done)
+
+    def welcome_frame(self, client, server_nonce=b""):
+        welcome = WELCOME.pack(client.id) + self.group.key + self.issue_ticket(client)
+        return encode_frame(MSG_WELCOME, server_nonce + client.uplink.encrypt(welcome))
+
+    def issue_ticket(self, client):
+        return self.tickets.encrypt(TICKET.pack(time.time() + TICKET_LIFETIME, client.codec) + client.uplink.key,
+                                    b"ticket")
+
+    def open_ticket(self, ticket):
+        # Returns the uplink key and payload codec the ticket was issued for.
+        try:
+            plain = self.tickets.decrypt(ticket, b"ticket")
+        except InvalidTag:
+            raise ProtocolError("Unknown ticket")  # forged, or from before a restart
+        expires, codec = TICKET.unpack_from(plain)
+        if expires < time.time():
+            raise ProtocolError("Expired ticket")
+        return plain[TICKET.size:], codec
+
+    def request_history(self, client, after, count, channel):
+        if channel.history is not None:
+            self.defer(lambda: channel.history.since(after, count),
+                       lambda records: self.send_history(client, records, channel))
+
+    def send_history(self, client, records, channel):
+        if records:
+            client.send(history_frame(self.group, records, client.codec, channel.id))
+
+    def broadcast(self, message, _client=None, channel=None):
+        # Stamp the channel's next sequence number, encrypt and frame once
+        # per payload codec in use and queue those same bytes objects for
+        # every subscriber, the sender included so it learns the message's
+        # place in the order. The lock only covers the enqueue; a stalled
+        # peer only fills its own bounded queue.
+        channel = channel or self.lobby
+        origin = _client.id if _client is not None else 0
+        body = message.encode('utf-8')
+        with self._publish_lock:
+            seq, ts = self.next_seq(channel, message)
+            frames = FrameVariants(lambda codec: chat_frame(self.group, seq, ts, origin, body, codec, channel.id))
+            evict = self.fan_out(frames, channel)
+        self.evict(evict)
+
+    def next_seq(self, channel, message):
+        # Called with _publish_lock held. The history store numbers what it
+        # stores; without one the channel keeps its own counter.
+        if channel.history is not None:
+            seq, ts = channel.history.append(message)
+        else:
+            seq, ts = channel.last_seq + 1, time.time()
+        channel.last_seq = seq
+        channel.record()
+        return seq, ts
+
+    def fan_out(self, frames, channel=None):
+        # Queue one message (FrameVariants) to every subscriber of the
+        # channel: O(subscribers), not O(connections). Called with
+        # _publish_lock held; returns the clients to evict afterwards.
+        started = time.perf_counter()
+        evict = []
+        recipients = 0
+        for client in (channel or self.lobby).subscribers:
+            if client.send(frames[client.codec]):
+                recipients += 1
+            else:
+                evict.append(client)
+        encode = frames.seconds
+        queued = time.perf_counter() - started - encode
+        self.broadcast_stats.record(recipients, encode, queued)
+        if encode:
+            self.metrics.encrypt_seconds.observe(encode)
+        self.metrics.fanout_seconds.observe(queued)
+        return evict
+
+    def evict(self, clients):
+        for client in clients:
+            self.evicted += 1  # slow consumer, see the overflow policy
+            self.metrics.evicted.inc()
+            self.remove_client(client, flush=False)
+
+    def reap_idle(self):
+        # Called every REAP_TICK by the transport. Only connections whose
+        # timer is due are looked at; one that turns out to be active again
+        # just gets a new timer.
+        # The handshake deadline counts from the accept, not from the last
+        # frame, so a peer cannot stay unauthenticated by sending pings.
+        now = time.monotonic()
+        for client in self.idle_timers.advance():
+            if client.closed or client not in self.clients:
+                continue
+            idle = now - client.last_seen
+            if client.uplink is None and now - client.accepted_at >= HANDSHAKE_TIMEOUT:
+                log.info("Reaping %s, no handshake after %.0f s", client.name, now - client.accepted_at)
+                self.metrics.reaped.inc()
+                self.remove_client(client, flush=False)
+            elif idle >= IDLE_TIMEOUT:
+                log.info("Reaping %s, silent for %.0f s", client.name, idle)
+                self.metrics.reaped.inc()
+                self.remove_client(client, flush=False)
+            elif client.uplink is None:
+                self.idle_timers.schedule(client, client.accepted_at + HANDSHAKE_TIMEOUT - now)
+            elif idle >= PING_INTERVAL:
+                client.send(encode_frame(MSG_PING, PING.pack(time.monotonic_ns())))
+                self.idle_timers.schedule(client, client.last_seen + IDLE_TIMEOUT - now)
+            else:
+                self.idle_timers.schedule(client, client.last_seen + PING_INTERVAL - now)
+
+    def remove_client(self, client, flush=True):
+        # Safe to call from any thread, any number of times, but not with
+        # _publish_lock held.
+        self.clients.remove(client.id)
+        with self._publish_lock:
+            # A copy: the client's reader may still be joining or leaving
+            # channels while the reaper or an eviction removes it.
+            for channel in list(client.channels.values()):
+                channel.subscribers.discard(client)
+        client.close(flush)
+
+    def shutdown(self):
+        notice = "Server is stopping...".encode('utf-8')
+        stopping = FrameVariants(lambda codec: chat_frame(self.group, NOTICE_SEQ, time.time(), 0, notice, codec))
+        for client in self.clients.snapshot():
+            try:
+                if client.joined:
+                    client.send(stopping[client.codec])  # Notify clients about server stop
+                self.remove_client(client)
+            except Exception as e:
+                log.warning("Error closing client: %s", e)
+        for channel in self.channel_list():
+            if channel.history is not None:
+                channel.history.close()
+        self.files.close()
+
+    def update_nickname(self, client, message):
+        nickname, sep, _ = message.partition(": ")  # clients send "nickname: text"
+        if sep:
+            client.nickname = nickname[:32]
+
+    def stats(self):
+        # Extra fields for the /stats endpoint.
+        return {
+            "broadcasts": self.broadcast_stats.summary(),
+            "queues": self.queue_summary(),
+            "channels": [channel.info() for channel in self.channel_list()],
+            "clients": [client.info() for client in self.clients.snapshot()],
+        }
+
+    def queue_depths(self):
+        return {client.name: len(client.queue) for client in self.clients}
+
+    def queue_summary(self):
+        clients = self.clients.snapshot()
+        if not clients:
+            return f"Queues: idle | evicted {self.evicted}"
+        deepest = max(clients, key=lambda client: len(client.queue))
+        dropped = sum(client.queue.dropped for client in clients)
+        return (f"Clients: {len(clients)} | Queues: deepest {len(deepest.queue)}/{self.queue_size} "
+                f"{deepest.name} | dropped {dropped} | evicted {self.evicted} | rooms {len(self.channels)}")
@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import warnings
+from array import array
+from protocol import (FrameDecoder, encode_frame, MSG_HELLO, MSG_CHAT, MSG_WELCOME, MSG_PING, MSG_PONG, SERVER_HELLO,
+                      WELCOME, CHAT_HEADER, RECV_SIZE)
+from session_crypto import KeyExchange, SessionCipher, KEY_SIZE
+
+# Load generator for the chat server. Starts async_server.py (or, with
+# --server cluster, the multi-process cluster.py) on localhost, or targets a
+# running server with --connect, connects N simulated
+# clients that do the real handshake and encryption, has some of them send
+# at a fixed rate and writes throughput, latency, delivery completeness and
+# server CPU/RSS to a JSON file.
+#
+#   python loadtest.py --clients 10 100 1000 --senders 10 --rate 5 --duration 10
+#   python loadtest.py --server cluster --server-arg=--workers=4 --clients 1000 10000
+#
+# The threaded hub only runs inside the Tk server: start server1.0.2.py,
+# press Start and use --connect IP:5555 --server-pid PID. Its rate limits
+# stay on, so keep --rate under 5 messages/sec per sender.
+# Servers up to 1.0.2 spoke the unframed key+iv/AES-CFB protocol; use
+# --protocol legacy --connect IP:5555 --server-pid PID to measure those.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPTS = {"async": os.path.join(HERE, "async_server.py"), "cluster": os.path.join(HERE, "cluster.py")}
+CONNECT_CONCURRENCY = 200
+
+
+class SessionClient:
+    def __init__(self, index, run):
+        self.index = index
+        self.run = run
+        self.sent = 0
+        self.received = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.decoder = FrameDecoder()
+        self.pending = []
+        hello = await self.wait_for(MSG_HELLO)
+        algorithm, = SERVER_HELLO.unpack_from(hello)
+        exchange = KeyExchange()
+        self.writer.write(encode_frame(MSG_HELLO, exchange.public_bytes))
+        self.uplink = SessionCipher(exchange.derive(hello[SERVER_HELLO.size:]), algorithm)
+        welcome = self.uplink.decrypt(await self.wait_for(MSG_WELCOME))
+        self.id, = WELCOME.unpack_from(welcome)
+        self.group = SessionCipher(welcome[WELCOME.size:WELCOME.size + KEY_SIZE], algorithm)
+
+    async def wait_for(self, msg_type):
+        while True:
+            while self.pending:
+                frame_type, payload = self.pending.pop(0)
+                if frame_type == msg_type:
+                    return payload
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.pending.extend(self.decoder.feed(data))
+
+    def send(self, text):
+        self.writer.write(encode_frame(MSG_CHAT, self.uplink.encrypt(text.encode('utf-8'))))
+
+    def on_chat(self, payload):
+        header = payload[:CHAT_HEADER.size]
+        seq, ts, origin = CHAT_HEADER.unpack(header)
+        if origin != self.id:  # our own message coming back in order
+            self.run.on_message(self, self.group.decrypt(payload[CHAT_HEADER.size:], header).decode('utf-8'))
+
+    async def receive_loop(self):
+        for msg_type, payload in self.pending:
+            if msg_type == MSG_CHAT:
+                self.on_chat(payload)
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return
+            for msg_type, payload in self.decoder.feed(data):
+                if msg_type == MSG_CHAT:
+                    self.on_chat(payload)
+                elif msg_type == MSG_PING:
+                    self.writer.write(encode_frame(MSG_PONG, payload))  # or the server reaps idle receivers
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class LegacyClient(SessionClient):
+    # 1.0.x wire format: raw key + iv, then one AES-CFB blob per send(). Each
+    # read is taken as one message, exactly like the old client did.
+    async def connect(self, host, port):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+        try:
+            from cryptography.hazmat.decrepit.ciphers.modes import CFB
+        except ImportError:
+            from cryptography.hazmat.primitives.ciphers.modes import CFB
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        key_iv = await self.reader.readexactly(48)
+        self._cipher = lambda: Cipher(algorithms.AES(key_iv[:32]), CFB(key_iv[32:]))
+
+    def _crypt(self, context, data):
+        return context.update(data) + context.finalize()
+
+    def send(self, text):
+        self.writer.write(self._crypt(self._cipher().encryptor(), text.encode('utf-8')))
+
+    async def receive_loop(self):
+        while True:
+            data = await self.reader.read(1024)
+            if not data:
+                return
+            self.run.on_message(self, self._crypt(self._cipher().decryptor(), data).decode('utf-8', 'replace'))
+
+
+class LoadRun:
+    def __init__(self, args, clients):
+        self.args = args
+        self.client_count = clients
+        self.sender_count = min(args.senders, clients)
+        self.latencies = array('d')
+        self.corrupted = 0
+
+    def on_message(self, client, text):
+        # "bench<sender>: <index> <sent time ns> <padding>"
+        try:
+            _, index, sent_ns = text.split(" ", 3)[:3]
+            self.latencies.append((time.time_ns() - int(sent_ns)) / 1e6)
+            client.received += 1
+        except ValueError:
+            self.corrupted += 1
+
+    def message(self, client):
+        text = f"bench{client.index}: {client.sent} {time.time_ns()} "
+        return text + "x" * max(self.args.size - len(text), 0)
+
+    async def sender(self, client, deadline):
+        interval = 1.0 / self.args.rate
+        next_send = time.perf_counter() + random.random() * interval  # spread senders out
+        while next_send < deadline:
+            await asyncio.sleep(max(next_send - time.perf_counter(), 0))
+            client.send(self.message(client))
+            client.sent += 1
+            next_send += interval
+
+    async def execute(self, host, port):
+        client_class = LegacyClient if self.args.protocol == "legacy" else SessionClient
+        clients = [client_class(i, self) for i in range(self.client_count)]
+        gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def connect(client):
+            async with gate:
+                await client.connect(host, port)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connect(client) for client in clients))
+        connect_time = time.perf_counter() - started
+        receivers = [asyncio.create_task(client.receive_loop()) for client in clients]
+
+        usage_before = server_usage(self.args.server_pid)
+        started = time.perf_counter()
+        deadline = started + self.args.duration
+        await asyncio.gather(*(self.sender(client, deadline) for client in clients[:self.sender_count]))
+        send_time = time.perf_counter() - started
+
+        total_sent = sum(client.sent for client in clients)
+        expected = sum(total_sent - client.sent for client in clients)  # senders don't get their own lines back
+        drain_deadline = time.perf_counter() + self.args.drain
+        while sum(client.received for client in clients) < expected and time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        usage_after = server_usage(self.args.server_pid)
+
+        for client in clients:
+            client.close()
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+
+        delivered = sum(client.received for client in clients)
+        complete = sum(1 for client in clients if client.received >= total_sent - client.sent)
+        latencies = sorted(self.latencies)
+        result = {
+            "clients": self.client_count,
+            "senders": self.sender_count,
+            "connect_seconds": round(connect_time, 3),
+            "sent": total_sent,
+            "send_rate_msgs_per_sec": round(total_sent / send_time, 1) if send_time else 0,
+            "delivered": delivered,
+            "expected": expected,
+            "delivery_ratio": round(delivered / expected, 5) if expected else 1.0,
+            "complete_clients": complete,
+            "corrupted": self.corrupted,
+            "delivered_msgs_per_sec": round(delivered / elapsed, 1) if elapsed else 0,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": round(latencies[-1], 3) if latencies else None,
+            },
+        }
+        if usage_before and usage_after:
+            result["server"] = {
+                "cpu_seconds": round(usage_after["cpu_seconds"] - usage_before["cpu_seconds"], 3),
+                "cpu_percent": round((usage_after["cpu_seconds"] - usage_before["cpu_seconds"]) / elapsed * 100, 1),
+                "rss_mb": usage_after["rss_mb"],
+                "peak_rss_mb": usage_after["peak_rss_mb"],
+            }
+        return result
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))], 3)
+
+
+def server_usage(pid):
+    # CPU seconds and RSS of the server and its child processes (the
+    # cluster's workers), added up.
+    if not pid:
+        return None
+    pids = [pid] + child_pids(pid)
+    usages = [usage for usage in map(process_usage, pids) if usage is not None]
+    if not usages:
+        return None
+    return {key: round(sum(usage[key] for usage in usages), 2) for key in usages[0]}
+
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+        return children + [grandchild for child in children for grandchild in child_pids(child)]
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return [child.pid for child in psutil.Process(pid).children(recursive=True)]
+    except Exception:  # no psutil, or the process is gone
+        return []
+
+
+def process_usage(pid):
+    # CPU seconds and RSS of one process, from /proc (Linux) or psutil.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        usage = {"cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks}
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        usage["rss_mb"] = round(int(status["VmRSS"].split()[0]) / 1024, 1)
+        usage["peak_rss_mb"] = round(int(status["VmHWM"].split()[0]) / 1024, 1)
+        return usage
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    process = psutil.Process(pid)
+    cpu = process.cpu_times()
+    memory = process.memory_info()
+    return {"cpu_seconds": cpu.user + cpu.system, "rss_mb": round(memory.rss / 2**20, 1),
+            "peak_rss_mb": round(getattr(memory, "peak_wset", memory.rss) / 2**20, 1)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port):
+    # Rate limits are off so the run measures the server, not its limits,
+    # and the metrics endpoint is off so it cannot clash with another server.
+    command = [sys.executable, SERVER_SCRIPTS[args.server], "--host", "127.0.0.1", "--port", str(port),
+               "--history", "", "--log-level", "WARNING", "--queue-size", str(args.queue_size),
+               "--metrics-port", "0", "--no-discovery",
+               "--rate", "0", "--byte-rate", "0", "--global-rate", "0"] + args.server_arg
+    process = subprocess.Popen(command)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server load test")
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100],
+                        help="connected clients per run; several values run a sweep")
+    parser.add_argument("--senders", type=int, default=10, help="how many of the clients send")
+    parser.add_argument("--rate", type=float, default=5.0, help="messages/sec per sender")
+    parser.add_argument("--size", type=int, default=100, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending per run")
+    parser.add_argument("--drain", type=float, default=10.0, help="max seconds to wait for stragglers")
+    parser.add_argument("--connect", help="HOST:PORT of a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid to sample CPU/RSS from with --connect")
+    parser.add_argument("--server", choices=sorted(SERVER_SCRIPTS), default="async",
+                        help="which server to spawn: async_server.py or the multi-process cluster.py")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra argument for the spawned server (repeatable)")
+    parser.add_argument("--queue-size", type=int, default=4096, help="per-client queue of the spawned server")
+    parser.add_argument("--protocol", choices=("session", "legacy"), default="session")
+    parser.add_argument("--label", default="", help="free text stored in the result, e.g. the server version")
+    parser.add_argument("--output", default=f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")  # CFB deprecation warnings in legacy mode
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    process = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        process = start_server(args, port)
+        args.server_pid = process.pid
+
+    runs = []
+    try:
+        for clients in args.clients:
+            result = asyncio.run(LoadRun(args, clients).execute(host, port))
+            runs.append(result)
+            latency = result["latency_ms"]
+            print(f"{clients:>6} clients: {result['delivered_msgs_per_sec']:>10} deliveries/s  "
+                  f"p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms  "
+                  f"delivered {result['delivery_ratio'] * 100:.2f}%"
+                  + (f"  server cpu {result['server']['cpu_percent']}% rss {result['server']['rss_mb']} MB"
+                     if "server" in result else ""))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(10)
+
+    report = {
+        "label": args.label,
+        "protocol": args.protocol,
+        "target": args.connect or f"spawned {os.path.basename(SERVER_SCRIPTS[args.server])}",
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"senders": args.senders, "rate": args.rate, "size": args.size,
+                   "duration": args.duration},
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
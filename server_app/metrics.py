@@ -0,0 +1,320 @@
+import bisect
+import collections
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+METRICS_PORT = 5557
+PROFILE_INTERVAL = 0.005  # seconds between profiler samples
+MIN_PROFILE_INTERVAL = 0.001
+# 50 us .. ~6.5 s, doubling
+DEFAULT_BUCKETS = tuple(0.00005 * 2 ** i for i in range(18))
+
+log = logging.getLogger("lesnet.metrics")
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, {}, self.value)]
+
+
+class Gauge:
+    # Either set() explicitly or computed at scrape time by `func`.
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [(self.name, {}, self.func() if self.func else self.value)]
+
+
+class GaugeFamily(Gauge):
+    # Gauges that share a name and differ by labels, e.g. one per channel;
+    # `func` returns [(labels, value)] at scrape time.
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.func()]
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation.
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        with self._lock:
+            counts, total, value_sum = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append((self.name + "_bucket", {"le": f"{bound:g}"}, cumulative))
+        samples.append((self.name + "_bucket", {"le": "+Inf"}, total))
+        samples.append((self.name + "_sum", {}, value_sum))
+        samples.append((self.name + "_count", {}, total))
+        return samples
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text):
+        return self._add(Counter(name, help_text))
+
+    def gauge(self, name, help_text, func=None):
+        return self._add(Gauge(name, help_text, func))
+
+    def gauge_family(self, name, help_text, func):
+        return self._add(GaugeFamily(name, help_text, func))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, buckets))
+
+    def render_prometheus(self):
+        kinds = {Counter: "counter", Gauge: "gauge", GaugeFamily: "gauge", Histogram: "histogram"}
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kinds[type(metric)]}")
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        result = {}
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                result[metric.name] = {
+                    "count": metric.count,
+                    "sum": metric.sum,
+                    "p50": metric.quantile(0.5),
+                    "p95": metric.quantile(0.95),
+                    "p99": metric.quantile(0.99),
+                }
+            elif isinstance(metric, GaugeFamily):
+                result[metric.name] = {",".join(map(str, labels.values())): value
+                                       for _, labels, value in metric.samples()}
+            else:
+                result[metric.name] = metric.samples()[0][2]
+        return result
+
+
+class ServerMetrics(MetricsRegistry):
+    # The standard set of server metrics; `clients` is the ClientRegistry.
+    def __init__(self, clients):
+        super().__init__()
+        self.accepted = self.counter("chat_connections_accepted_total", "Accepted connections")
+        self.active = self.gauge("chat_connections_active", "Currently connected clients", lambda: len(clients))
+        self.resumed = self.counter("chat_sessions_resumed_total", "Reconnects that resumed with a ticket")
+        self.reaped = self.counter("chat_connections_reaped_total", "Idle or dead connections closed by the reaper")
+        self.evicted = self.counter("chat_connections_evicted_total", "Slow consumers disconnected by the send queue")
+        self.messages = self.counter("chat_messages_total", "Chat messages received")
+        self.throttled = self.counter("chat_frames_throttled_total", "Frames dropped by the rate limiter")
+        self.throttled_bytes = self.counter("chat_bytes_throttled_total", "Bytes in frames dropped by the rate limiter")
+        self.flooders = self.counter("chat_connections_flooding_total", "Clients disconnected for flooding")
+        self.bytes_in = self.counter("chat_bytes_in_total", "Bytes received from clients")
+        self.bytes_out = self.counter("chat_bytes_out_total", "Bytes written to client sockets")
+        self.files = self.counter("chat_files_uploaded_total", "Completed file uploads")
+        self.file_bytes_in = self.counter("chat_file_bytes_in_total", "File bytes received from uploaders")
+        self.file_bytes_out = self.counter("chat_file_bytes_out_total", "Spooled file bytes sent to downloaders")
+        self.file_offers = self.counter("chat_file_offers_total", "Uploads offered by content hash")
+        self.file_dedup_hits = self.counter("chat_file_dedup_hits_total",
+                                            "Offered uploads the server already had, so nothing was sent")
+        self.file_bytes_saved = self.counter("chat_file_bytes_saved_total", "Upload bytes skipped by deduplication")
+        self.gauge("chat_file_dedup_ratio", "Share of offered uploads the server already had",
+                   lambda: round(self.file_dedup_hits.value / max(1, self.file_offers.value), 3))
+        self.writes = self.counter("chat_socket_writes_total", "Batched writes to client sockets")
+        self.decrypt_seconds = self.histogram("chat_decrypt_seconds", "Time to decrypt one inbound message")
+        self.encrypt_seconds = self.histogram("chat_encrypt_seconds", "Time to encrypt and frame one broadcast")
+        self.fanout_seconds = self.histogram("chat_broadcast_fanout_seconds", "Time to queue one broadcast to everyone")
+        self.ping_rtt = self.histogram("chat_ping_rtt_seconds", "Round trip of server pings to idle clients")
+        self.send_latency = self.histogram("chat_send_latency_seconds",
+                                           "Time from queueing a frame to handing it to the client socket")
+
+
+class SamplingProfiler:
+    # Statistical profiler that can be switched on and off while the server
+    # runs: a background thread snapshots every other thread's stack via
+    # sys._current_frames() and counts identical stacks.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()  # stacks is written by the sampler, read by report()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        if self.running:
+            return
+        if interval:
+            self.interval = max(interval, MIN_PROFILE_INTERVAL)
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+        self.started = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def report(self, limit=40):
+        # Folded stacks ("a;b;c count"), ready for flamegraph.pl / speedscope.
+        with self._lock:
+            samples = self.samples
+            top = self.stacks.most_common(limit)
+        lines = [f"# {samples} samples every {self.interval * 1000:g} ms"
+                 f"{' (running)' if self.running else ''}"]
+        for stack, count in top:
+            lines.append(f"{stack} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # Local HTTP endpoint:
+    #   /metrics          Prometheus text format
+    #   /stats            JSON metrics plus whatever `extra()` returns
+    #   /profile          folded stacks from the sampling profiler
+    #   /profile/start    start sampling (optional ?interval=seconds)
+    #   /profile/stop     stop sampling
+    def __init__(self, metrics, extra=None, host="127.0.0.1", port=METRICS_PORT, profiler=None):
+        self.metrics = metrics
+        self.extra = extra
+        self.profiler = profiler or SamplingProfiler()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/metrics":
+                    self.reply(server.metrics.render_prometheus(), "text/plain; version=0.0.4")
+                elif url.path == "/stats":
+                    stats = server.metrics.as_dict()
+                    if server.extra:
+                        stats.update(server.extra())
+                    self.reply(json.dumps(stats, indent=2, default=str), "application/json")
+                elif url.path == "/profile/start":
+                    interval = parse_qs(url.query).get("interval", [None])[0]
+                    try:
+                        interval = float(interval) if interval else None
+                    except ValueError:
+                        interval = math.nan
+                    if interval is not None and not math.isfinite(interval):
+                        self.send_error(400, "interval must be a number of seconds")
+                        return
+                    server.profiler.start(interval)
+                    self.reply("profiler started\n")
+                elif url.path == "/profile/stop":
+                    server.profiler.stop()
+                    self.reply(server.profiler.report())
+                elif url.path == "/profile":
+                    self.reply(server.profiler.report())
+                else:
+                    self.send_error(404)
+
+            def reply(self, body, content_type="text/plain"):
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", content_type + "; charset=utf-8"
+                                 if "charset" not in content_type else content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.address = self.httpd.server_address
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.profiler.stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
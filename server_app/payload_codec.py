@@ -0,0 +1,134 @@
+import threading
+import zlib
+from protocol import MAX_FRAME_SIZE
+
+try:
+    import zstandard  # optional, better ratio and faster than zlib
+except ImportError:
+    zstandard = None
+
+# Shared by server_app and client_app; keep both copies identical.
+#
+# Optional compression of chat and history plaintext, applied before
+# encryption (ciphertext does not compress). A client lists the codecs it
+# can decode after its public key in MSG_HELLO; from then on the plaintext
+# of every MSG_CHAT and MSG_HISTORY in either direction starts with one
+# codec byte. Clients that list nothing get UNPREFIXED, the old format.
+CODEC_RAW = 0   # sent as is, e.g. too small to be worth it
+CODEC_ZLIB = 1  # raw deflate with PRESET as the dictionary
+CODEC_ZSTD = 2  # zstandard with PRESET as a raw-content dictionary
+UNPREFIXED = 0xFF  # never on the wire: the peer did not negotiate
+COMPRESS_MIN = 32  # bytes; shorter lines rarely shrink, see bench_compression.py
+ZLIB_LEVEL = 6
+ZLIB_WBITS = -12  # raw deflate, 4 KiB window: small state, cheap to copy per message
+ZLIB_MEMLEVEL = 4
+ZSTD_LEVEL = 3
+
+# Text that chat payloads tend to share, so even a single message finds
+# matches. The most common strings go last, where back references are
+# shortest. Changing this breaks compatibility with older peers.
+PRESET = "".join([
+    "https://www.http://.com/.html.pdf.png.jpg",
+    "Server is stopping...You are sending too fast; your messages are being dropped.",
+    "I don't understand the question. Can you explain that again, please? Could you repeat that? ",
+    "What is the answer to the homework for the next class? Is it on the test? ",
+    "Thank you very much! I have a question about the assignment. Yes, no, OK, sorry, ",
+    "よろしくお願いします。ありがとうございます。すみません、質問があります。",
+    "わかりました。わかりません。もう一度説明してください。宿題の提出はいつまでですか?",
+    "先生、テストの範囲はどこまでですか?これで合っていますか?はい、いいえ、大丈夫です。",
+    "の、は、が、を、に、で、と、も、です。ます。でしょうか?ください。",
+    "the and to of is in it that you for this with on are be have not ",
+]).encode('utf-8')
+
+
+class CodecError(ValueError):
+    pass
+
+
+def supported():
+    # Codecs this side can decode, best first.
+    return bytes([CODEC_ZSTD, CODEC_ZLIB] if zstandard is not None else [CODEC_ZLIB])
+
+
+def negotiate(offered):
+    # The best codec both sides support; CODEC_RAW if there is none.
+    for codec in supported():
+        if codec in offered:
+            return codec
+    return CODEC_RAW
+
+
+def encode_payload(codec, data):
+    # Codec byte + body, compressed if that makes it smaller.
+    if codec == UNPREFIXED:
+        return data
+    if codec != CODEC_RAW and len(data) >= COMPRESS_MIN:
+        packed = _COMPRESS[codec](data)
+        if len(packed) < len(data):
+            return bytes([codec]) + packed
+    return b"\0" + data
+
+
+def decode_payload(codec, data):
+    # `codec` is what the connection negotiated, the data says what was used.
+    if codec == UNPREFIXED:
+        return data
+    if not data:
+        raise CodecError("Missing codec byte")
+    used = data[0]
+    if used == CODEC_RAW:
+        return data[1:]
+    if used not in _DECOMPRESS:
+        raise CodecError(f"Unsupported codec {used}")
+    return _DECOMPRESS[used](data[1:])
+
+
+# zlib objects primed with the dictionary are copied for each message,
+# which is much cheaper than loading the dictionary again.
+_zlib_compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, ZLIB_WBITS, ZLIB_MEMLEVEL, zdict=PRESET)
+_zlib_decompressor = zlib.decompressobj(ZLIB_WBITS, zdict=PRESET)
+
+
+def _zlib_compress(data):
+    compressor = _zlib_compressor.copy()
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompress(data):
+    decompressor = _zlib_decompressor.copy()
+    try:
+        plain = decompressor.decompress(data, MAX_FRAME_SIZE)  # bounded, no decompression bombs
+    except zlib.error as e:
+        raise CodecError(str(e))
+    if not decompressor.eof or decompressor.unconsumed_tail:
+        raise CodecError("Truncated or oversized zlib payload")
+    return plain
+
+
+_COMPRESS = {CODEC_ZLIB: _zlib_compress}
+_DECOMPRESS = {CODEC_ZLIB: _zlib_decompress}
+
+if zstandard is not None:
+    # zstd contexts are not thread safe, so every thread gets its own pair.
+    _zstd_dict = zstandard.ZstdCompressionDict(PRESET, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    _zstd_local = threading.local()
+
+    def _zstd_contexts():
+        if not hasattr(_zstd_local, "compressor"):
+            _zstd_local.compressor = zstandard.ZstdCompressor(ZSTD_LEVEL, dict_data=_zstd_dict)
+            _zstd_local.decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dict)
+        return _zstd_local
+
+    def _zstd_compress(data):
+        return _zstd_contexts().compressor.compress(data)
+
+    def _zstd_decompress(data):
+        try:
+            if zstandard.frame_content_size(data) > MAX_FRAME_SIZE:
+                raise CodecError("Oversized zstd payload")
+            return _zstd_contexts().decompressor.decompress(data, max_output_size=MAX_FRAME_SIZE)
+        except zstandard.ZstdError as e:
+            raise CodecError(str(e))
+
+    _COMPRESS[CODEC_ZSTD] = _zstd_compress
+    _DECOMPRESS[CODEC_ZSTD] = _zstd_decompress
@@ -0,0 +1,200 @@
+import hashlib
+import re
+import struct
+
+# Shared by server_app and client_app; keep both copies identical.
+#
+# Every frame on the wire is a 4-byte big-endian payload length, a 1-byte
+# message type and then the payload itself. TCP is a byte stream, so a single
+# recv() may return half a frame or several frames at once; FrameDecoder
+# takes care of both.
+HEADER = struct.Struct("!IB")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+# Message types
+MSG_HELLO = 0x01    # key exchange: server sends algorithm + public key, client answers with its public key
+MSG_CHAT = 0x02     # encrypted chat line; server -> client lines start with CHAT_HEADER
+MSG_WELCOME = 0x03  # server -> client: connection id + broadcast key, encrypted under the uplink key;
+                    # after a RESUME, preceded by the server's resume nonce in the clear
+MSG_HISTORY = 0x04  # server -> client: batch of past messages, encrypted under the broadcast key
+MSG_HISTORY_REQUEST = 0x05  # client -> server: messages after a sequence number
+MSG_RESUME = 0x06   # client -> server, instead of MSG_HELLO: resume a session with a ticket
+MSG_PING = 0x07     # either direction: are you still there? answered with MSG_PONG and the same payload
+MSG_PONG = 0x08
+MSG_SUBSCRIBE = 0x09    # client -> server: SUBSCRIBE + channel name; answered with the channel's replay
+MSG_UNSUBSCRIBE = 0x0A  # client -> server: channel name
+MSG_CHANNEL_CHAT = 0x0B     # MSG_CHAT in a channel other than the lobby: CHANNEL, then what MSG_CHAT carries
+MSG_CHANNEL_HISTORY = 0x0C  # MSG_HISTORY for a channel other than the lobby: CHANNEL, then the same
+MSG_UPLOAD = 0x0D        # client -> server: TRANSFER, start or resume an upload; answered with MSG_TRANSFER_ACK
+MSG_UPLOAD_CHUNK = 0x0E  # client -> server: CHUNK, then the chunk encrypted under the uplink key
+MSG_DOWNLOAD = 0x0F      # client -> server: CREDIT, stream a file from an offset
+MSG_FILE_CHUNK = 0x10    # server -> client: CHUNK, then the chunk encrypted under the broadcast key
+MSG_TRANSFER_ACK = 0x11  # either direction: CREDIT for a transfer in the other direction
+
+SERVER_HELLO = struct.Struct("!B")  # cipher algorithm, followed by the server public key
+WELCOME = struct.Struct("!I")       # connection id, followed by the broadcast key and a resumption ticket
+HISTORY_REQUEST = struct.Struct("!QI")  # after seq, max count, followed by CHANNEL outside the lobby
+RESUME = struct.Struct("!Q16s")         # last seq seen, client nonce, followed by the ticket
+PING = struct.Struct("!Q")              # sender's clock in nanoseconds, echoed back unchanged
+HISTORY_RECORD = struct.Struct("!QdI")  # seq, server timestamp, body length, followed by the UTF-8 body
+# Server -> client chat: sequence number, server timestamp and the sender's
+# connection id in the clear, then the ciphertext, with the header as the
+# AEAD associated data so it cannot be altered. Sequence numbers increase by
+# one per message in the order everyone receives them; seq 0 is an
+# unsequenced server notice.
+CHAT_HEADER = struct.Struct("!QdI")
+NOTICE_SEQ = 0
+# Channels (rooms). Everyone starts in the lobby, which uses the plain
+# MSG_CHAT/MSG_HISTORY frames, so clients that know nothing about channels
+# keep working. Every other channel is numbered by a hash of its name, so
+# both sides agree on the number without asking. Each channel has its own
+# sequence numbers and history. In MSG_CHANNEL_CHAT the channel number is
+# part of the associated data too: client -> server it is the whole of it,
+# server -> client it comes in front of CHAT_HEADER.
+CHANNEL = struct.Struct("!I")
+SUBSCRIBE = struct.Struct("!Q")  # last seq seen in the channel, 0 for the usual replay
+LOBBY = "lobby"
+LOBBY_ID = 0
+MAX_CHANNEL_NAME = 32  # bytes of UTF-8
+# File transfers. A file goes over in CHUNK_SIZE pieces, each encrypted on
+# its own with CHUNK (transfer id + offset) as the associated data, so no
+# chunk can be moved to another place or file. Flow control is by credit:
+# MSG_TRANSFER_ACK says everything before `offset` arrived and the sender
+# may go on up to (not including) `limit`, so a transfer never has more
+# than TRANSFER_WINDOW in flight. The transfer id is the file's content
+# hash (blob_hash()), so a file the server already has is never sent again
+# and a client can cache files by id. The server's first ACK carries the
+# offset to start from: the file size if it has the file, more than 0 when
+# resuming after a reconnect. A limit of 0 means refused (a notice says
+# why). A finished upload is announced with an ordinary chat line
+# containing file_link(), which is all a downloader needs.
+TRANSFER = struct.Struct("!16sQ8s")  # transfer id, file size, uploader's token (the same across reconnects)
+CHUNK = struct.Struct("!16sQ")     # transfer id, offset of the chunk in the file
+CREDIT = struct.Struct("!16sQQ")   # transfer id, offset, limit
+TRANSFER_ID_SIZE = 16
+CHUNK_SIZE = 64 * 1024
+TRANSFER_WINDOW = 16 * CHUNK_SIZE
+MAX_FILE_SIZE = 100 * 1024 * 1024
+FILE_LINK = re.compile(r"lesnet-file:([0-9a-f]{32}):([0-9]+)")  # transfer id, file size
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(msg_type, payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), msg_type) + payload
+
+
+def is_sequenced_chat(frame):
+    # A server -> client chat frame with a sequence number: if it is lost,
+    # the client sees the gap and fetches the message from the history.
+    msg_type = frame[4] if len(frame) > HEADER_SIZE else None
+    if msg_type == MSG_CHAT:
+        start = HEADER_SIZE
+    elif msg_type == MSG_CHANNEL_CHAT:
+        start = HEADER_SIZE + CHANNEL.size
+    else:
+        return False
+    seq = frame[start:start + 8]
+    return len(seq) == 8 and any(seq)  # NOTICE_SEQ (0) is not sequenced
+
+
+def channel_id(name):
+    if name == LOBBY:
+        return LOBBY_ID
+    digest = hashlib.blake2s(name.encode('utf-8'), digest_size=CHANNEL.size).digest()
+    return int.from_bytes(digest, "big") or 1  # 0 is the lobby
+
+
+def blob_hash():
+    # Feed it the file's bytes; digest() is the transfer id.
+    return hashlib.blake2b(digest_size=TRANSFER_ID_SIZE)
+
+
+def file_link(transfer_id, size):
+    return f"lesnet-file:{transfer_id.hex()}:{size}"
+
+
+def pack_history(records):
+    parts = []
+    for seq, ts, body in records:
+        data = body.encode('utf-8')
+        parts.append(HISTORY_RECORD.pack(seq, ts, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_history(payload):
+    records = []
+    offset = 0
+    while offset < len(payload):
+        seq, ts, length = HISTORY_RECORD.unpack_from(payload, offset)
+        offset += HISTORY_RECORD.size
+        records.append((seq, ts, payload[offset:offset + length].decode('utf-8')))
+        offset += length
+    return records
+
+
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=RECV_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray(buffer_size)
+        self._start = 0  # first unread byte
+        self._end = 0    # one past the last received byte
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        # Make room for `size` more bytes at the end of the buffer: slide
+        # unread bytes to the front first, and only grow if that is not enough.
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start:
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        missing = size - (len(self._buf) - self._end)
+        if missing > 0:
+            self._buf.extend(bytes(max(missing, len(self._buf))))
+
+    def feed(self, data):
+        size = len(data)
+        self._reserve(size)
+        self._buf[self._end:self._end + size] = data
+        self._end += size
+        return self.frames()
+
+    def recv_from(self, sock, size=RECV_SIZE):
+        # Receive straight into the decoder's buffer. Returns the list of
+        # complete frames (possibly empty), or None once the peer has closed.
+        self._reserve(size)
+        with memoryview(self._buf)[self._end:self._end + size] as view:
+            nbytes = sock.recv_into(view)
+        if not nbytes:
+            return None
+        self._end += nbytes
+        return self.frames()
+
+    def frames(self):
+        frames = []
+        start, end = self._start, self._end
+        with memoryview(self._buf) as view:
+            while end - start >= HEADER_SIZE:
+                length, msg_type = HEADER.unpack_from(view, start)
+                if length > self.max_frame_size:
+                    raise FrameError(f"Frame too large: {length} bytes")
+                body = start + HEADER_SIZE
+                if end - body < length:
+                    break
+                frames.append((msg_type, bytes(view[body:body + length])))
+                start = body + length
+        if start == end:
+            start = end = 0  # everything consumed, reuse the buffer from the top
+        self._start, self._end = start, end
+        return frames
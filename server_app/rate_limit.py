@@ -0,0 +1,130 @@
+import threading
+import time
+
+# Per connection: sustained messages per second and how many may come at once
+CLIENT_RATE = 5.0
+CLIENT_BURST = 20
+# Per connection: bytes per second, the burst also caps a single message
+CLIENT_BYTE_RATE = 32 * 1024
+CLIENT_BYTE_BURST = 256 * 1024
+# All chat messages together, which bounds the broadcast fan-out work
+GLOBAL_RATE = 200.0
+GLOBAL_BURST = 400
+# Dropped messages a client may rack up (refilling at one per second)
+# before it is disconnected
+STRIKE_RATE = 1.0
+STRIKE_BURST = 50
+
+ADMIT = "admit"
+THROTTLE = "throttle"
+DISCONNECT = "disconnect"
+
+
+class TokenBucket:
+    # Holds up to `burst` tokens and refills at `rate` per second. The
+    # refill is computed from the elapsed time when someone asks, so a
+    # check is O(1) and there is no timer.
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def refund(self, amount=1):
+        # Gives back tokens taken for something that then did not happen.
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + amount)
+
+
+class Unlimited:
+    def consume(self, amount=1):
+        return True
+
+    def refund(self, amount=1):
+        pass
+
+
+UNLIMITED = Unlimited()
+
+
+def bucket(rate, burst):
+    # A rate of 0 switches that limit off, e.g. for load tests.
+    return TokenBucket(rate, burst) if rate > 0 else UNLIMITED
+
+
+class ClientLimits:
+    def __init__(self, guard):
+        self.messages = bucket(guard.rate, guard.burst)
+        self.bytes = bucket(guard.byte_rate, guard.byte_burst)
+        self.strikes = TokenBucket(STRIKE_RATE, guard.strikes)
+        self.throttled = 0
+        self.warned = False  # told about the current throttling streak
+
+
+class FloodGuard:
+    # Checked for every frame before anything is decrypted or broadcast.
+    # The client's own buckets go first, so a flooder runs out of its own
+    # tokens long before it can eat into the global budget everyone shares.
+    # Only a client over its own limits gets a strike: one caught in
+    # somebody else's burst is throttled, and keeps its tokens.
+    def __init__(self, rate=CLIENT_RATE, burst=CLIENT_BURST, byte_rate=CLIENT_BYTE_RATE,
+                 byte_burst=CLIENT_BYTE_BURST, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 strikes=STRIKE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.strikes = strikes
+        self.global_bucket = bucket(global_rate, global_burst)
+
+    def attach(self, client):
+        client.limits = ClientLimits(self)
+
+    def check(self, client, nbytes, broadcast=False):
+        # Returns ADMIT, THROTTLE (drop this frame) or DISCONNECT.
+        limits = client.limits
+        if not limits.messages.consume():
+            limits.throttled += 1
+            return THROTTLE if limits.strikes.consume() else DISCONNECT
+        if not limits.bytes.consume(nbytes):
+            limits.messages.refund()
+            limits.throttled += 1
+            return THROTTLE if limits.strikes.consume() else DISCONNECT
+        if broadcast and not self.global_bucket.consume():
+            limits.messages.refund()
+            limits.bytes.refund(nbytes)
+            limits.throttled += 1
+            return THROTTLE
+        limits.warned = False
+        return ADMIT
+
+
+def add_rate_limit_arguments(parser):
+    group = parser.add_argument_group("rate limits")
+    group.add_argument("--rate", type=float, default=CLIENT_RATE, help="messages per second per client, 0 for no limit")
+    group.add_argument("--burst", type=int, default=CLIENT_BURST, help="messages a client may send at once")
+    group.add_argument("--byte-rate", type=int, default=CLIENT_BYTE_RATE, help="bytes per second per client")
+    group.add_argument("--byte-burst", type=int, default=CLIENT_BYTE_BURST,
+                       help="bytes a client may send at once, also the largest message")
+    group.add_argument("--global-rate", type=float, default=GLOBAL_RATE, help="chat messages per second for everyone")
+    group.add_argument("--global-burst", type=int, default=GLOBAL_BURST)
+    group.add_argument("--strikes", type=int, default=STRIKE_BURST,
+                       help="dropped messages before a flooding client is disconnected")
+
+
+def flood_guard_from_args(args, workers=1):
+    # Processes sharing one port split the global budget between them.
+    return FloodGuard(args.rate, args.burst, args.byte_rate, args.byte_burst, args.global_rate / workers,
+                      max(1, args.global_burst // workers), args.strikes)
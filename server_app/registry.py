@@ -0,0 +1,50 @@
+import itertools
+import threading
+
+
+class ClientRegistry:
+    # Connections keyed by id. add()/remove() are O(1) under a short lock and
+    # drop the cached snapshot; readers iterate an immutable tuple, so a
+    # disconnect in the middle of a broadcast can never skip or repeat a client.
+    def __init__(self, first_id=1, id_step=1):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._snapshot = ()
+        self._ids = itertools.count(first_id, id_step)  # cluster workers interleave their ids
+
+    def next_id(self):
+        return next(self._ids)
+
+    def add(self, client):
+        with self._lock:
+            self._clients[client.id] = client
+            self._snapshot = None
+
+    def remove(self, client_id):
+        # Returns the connection, or None if someone else removed it first.
+        with self._lock:
+            client = self._clients.pop(client_id, None)
+            if client is not None:
+                self._snapshot = None
+            return client
+
+    def get(self, client_id):
+        return self._clients.get(client_id)
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._clients.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __contains__(self, client):
+        return client.id in self._clients
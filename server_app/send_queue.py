@@ -0,0 +1,136 @@
+import collections
+import threading
+import time
+from protocol import is_sequenced_chat
+
+# What to do when a client's outbound queue is full
+DROP_OLDEST = "drop-oldest"  # discard the oldest queued chat frame, evict if there is none
+COALESCE = "coalesce"        # merge queued frames into one write, evict once over the byte budget
+DISCONNECT = "disconnect"    # evict the slow consumer straight away
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+SEND_QUEUE_SIZE = 256
+SEND_QUEUE_BYTES = 4 * 1024 * 1024
+
+# Optional write coalescing: hold the first queued frame for up to
+# FLUSH_WINDOW seconds (or until FLUSH_BYTES are queued) so a burst goes out
+# in one vectored write instead of one syscall per message.
+FLUSH_WINDOW = 0.005
+FLUSH_BYTES = 64 * 1024
+
+
+class SendQueue:
+    # Bounded outbound queue for one connection. put() never blocks the
+    # broadcasting thread; the connection's own writer drains it. Entries are
+    # always whole frames (or whole frames joined together), so dropping one
+    # never corrupts the byte stream. Only frames `droppable` accepts are
+    # ever dropped: losing a WELCOME, PONG or transfer ACK would wedge the
+    # session, while a lost chat line is fetched again by the client.
+    def __init__(self, maxlen=SEND_QUEUE_SIZE, policy=DROP_OLDEST, max_bytes=SEND_QUEUE_BYTES, on_ready=None,
+                 flush_window=0.0, flush_bytes=FLUSH_BYTES, droppable=is_sequenced_chat):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxlen = maxlen
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.on_ready = on_ready
+        self.flush_window = flush_window  # 0 writes as soon as anything is queued
+        self.flush_bytes = flush_bytes
+        self.droppable = droppable
+        self._frames = collections.deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self.nbytes = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.closed = False
+        self._woken = False  # wake() was called: there may be bulk data to send
+        self._since = None          # when the oldest queued frame was put
+        self.batch_started = None   # the same, for the batch last taken by drain()/get()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame):
+        # Returns False when the consumer should be disconnected.
+        with self._lock:
+            if self.closed:
+                return False
+            if len(self._frames) >= self.maxlen or self.nbytes + len(frame) > self.max_bytes:
+                if self.policy == DISCONNECT:
+                    return False
+                if self.policy == COALESCE:
+                    if self.nbytes + len(frame) > self.max_bytes:
+                        return False
+                    self._frames = collections.deque([b"".join(self._frames)])
+                else:
+                    index = 0
+                    while len(self._frames) >= self.maxlen or self.nbytes + len(frame) > self.max_bytes:
+                        while index < len(self._frames) and not self.droppable(self._frames[index]):
+                            index += 1
+                        if index == len(self._frames):
+                            return False  # nothing left we may drop
+                        self.nbytes -= len(self._frames[index])
+                        del self._frames[index]
+                        self.dropped += 1
+            if not self._frames:
+                self._since = time.perf_counter()
+            self._frames.append(frame)
+            self.nbytes += len(frame)
+            if len(self._frames) > self.high_water:
+                self.high_water = len(self._frames)
+            self._ready.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def drain(self):
+        with self._lock:
+            return self._take()
+
+    def get(self, timeout=None):
+        # Blocking drain for writer threads: waits for at least one frame,
+        # then for the rest of the flush window if coalescing.
+        with self._lock:
+            if not self._frames and not self.closed and not self._woken:
+                self._ready.wait(timeout)
+            self._woken = False
+            while True:
+                delay = self._flush_delay()
+                if not delay:
+                    break
+                self._ready.wait(delay)
+            return self._take()
+
+    def wake(self):
+        # Wakes the writer without queueing anything, e.g. when a file
+        # download got more credit; see BaseConnection.next_download().
+        with self._lock:
+            self._woken = True
+            self._ready.notify()
+        if self.on_ready:
+            self.on_ready()
+
+    def flush_delay(self):
+        # Seconds a writer should still wait for more frames, 0 to write now.
+        with self._lock:
+            return self._flush_delay()
+
+    def _flush_delay(self):
+        if not self.flush_window or not self._frames or self.closed or self.nbytes >= self.flush_bytes:
+            return 0
+        return max(0, self._since + self.flush_window - time.perf_counter())
+
+    def _take(self):
+        frames = list(self._frames)
+        self._frames.clear()
+        self.nbytes = 0
+        self.batch_started, self._since = self._since, None
+        return frames
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._ready.notify_all()
+        if self.on_ready:
+            self.on_ready()
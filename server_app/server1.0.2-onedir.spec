@@ -0,0 +1,49 @@
+# -*- mode: python ; coding: utf-8 -*-
+# Unpacked ("one-dir") build: dist/server1.0.2/server1.0.2.exe next to its libraries.
+# It starts much faster than the one-file server1.0.2.spec build, which unpacks
+# itself into a temp directory on every launch; no UPX either, since
+# decompressing the DLLs costs more at startup than it saves on disk.
+
+
+a = Analysis(
+    ['server1.0.2.py'],
+    pathex=[],
+    binaries=[],
+    datas=[],
+    hiddenimports=[],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=['unittest', 'pydoc', 'doctest'],
+    noarchive=False,
+    optimize=0,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='server1.0.2',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+    icon=['server_icon.ico'],
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='server1.0.2',
+)
@@ -1,145 +1,198 @@
-import socket
-import threading
-import tkinter as tk
-from tkinter import scrolledtext
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-import os
-
-BROADCAST_PORT = 5555
-BUFFER_SIZE = 1024
-
-class ChatServer:
-    def __init__(self, master):
-        self.master = master
-        self.master.title("Chat Server 1.0.2")  # Version number added here
-
-        self.server = None
-        self.clients = []
-        self.is_running = False
-
-        self.key = os.urandom(32)  # AES-256 key
-        self.iv = os.urandom(16)   # AES block size
-
-        self.start_button = tk.Button(master, text="Start Server", command=self.start_server)
-        self.start_button.pack(pady=5)
-        
-        self.stop_button = tk.Button(master, text="Stop Server", command=self.stop_server, state=tk.DISABLED)
-        self.stop_button.pack(pady=5)
-
-        self.messages_frame = tk.Frame(master)
-        scrollbar = tk.Scrollbar(self.messages_frame)
-        self.msg_list = scrolledtext.ScrolledText(self.messages_frame, height=15, width=50, yscrollcommand=scrollbar.set, wrap=tk.WORD)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.msg_list.pack(side=tk.LEFT, fill=tk.BOTH)
-        self.msg_list.pack()
-        self.messages_frame.pack(pady=10)
-
-        self.local_ip_label = tk.Label(master, text="Server IP: Not running")
-        self.local_ip_label.pack(pady=5)
-
-        # Adding version label
-        self.version_label = tk.Label(master, text="Version 1.0.2", font=("Arial", 10))
-        self.version_label.pack(side=tk.TOP, anchor="ne", padx=10, pady=5)
-
-    def encrypt(self, plaintext):
-        encryptor = Cipher(
-            algorithms.AES(self.key),
-            modes.CFB(self.iv),
-            backend=default_backend()
-        ).encryptor()
-        return encryptor.update(plaintext.encode('utf-8')) + encryptor.finalize()
-
-    def decrypt(self, ciphertext):
-        decryptor = Cipher(
-            algorithms.AES(self.key),
-            modes.CFB(self.iv),
-            backend=default_backend()
-        ).decryptor()
-        return decryptor.update(ciphertext) + decryptor.finalize()
-
-    def broadcast(self, message, _client):
-        for client in self.clients:
-            if client != _client:
-                try:
-                    encrypted_message = self.encrypt(message)
-                    client.send(encrypted_message)
-                except:
-                    client.close()
-                    self.clients.remove(client)
-
-    def handle_client(self, client):
-        while self.is_running:
-            try:
-                encrypted_message = client.recv(1024)
-                if not encrypted_message:
-                    break
-                message = self.decrypt(encrypted_message).decode('utf-8')
-                self.broadcast(message, client)
-                self.msg_list.insert(tk.END, message + "\n")
-                self.msg_list.yview(tk.END)
-            except:
-                client.close()
-                self.clients.remove(client)
-                break
-
-    def start_server(self):
-        if not self.is_running:
-            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server.bind((self.get_ip_address(), BROADCAST_PORT))
-            self.server.listen()
-            self.is_running = True
-            self.start_button.config(state=tk.DISABLED)
-            self.stop_button.config(state=tk.NORMAL)
-            self.local_ip_label.config(text=f"Server IP: {self.get_ip_address()}")
-            threading.Thread(target=self.accept_clients).start()
-            self.msg_list.insert(tk.END, "Server started...\n")
-
-    def accept_clients(self):
-        self.server.settimeout(1)  # Set a timeout for accept
-        while self.is_running:
-            try:
-                client, addr = self.server.accept()
-                self.msg_list.insert(tk.END, f"Connected with {addr}\n")
-                self.clients.append(client)
-                client.send(self.key + self.iv)  # Send key and IV to client
-                thread = threading.Thread(target=self.handle_client, args=(client,))
-                thread.start()
-            except socket.timeout:
-                continue
-            except OSError:
-                break
-
-    def stop_server(self):
-        if self.is_running:
-            self.is_running = False
-            for client in self.clients:
-                try:
-                    client.send(self.encrypt("Server is stopping..."))  # Notify clients about server stop
-                    client.close()
-                except Exception as e:
-                    print(f"Error closing client: {e}")
-            if self.server:
-                self.server.close()
-            self.start_button.config(state=tk.NORMAL)
-            self.stop_button.config(state=tk.DISABLED)
-            self.local_ip_label.config(text="Server IP: Not running")
-            self.msg_list.insert(tk.END, "Server stopped...\n")
-            self.master.quit()
-
-    def get_ip_address(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(('8.8.8.8', 80))
-            ip = s.getsockname()[0]
-            s.close()
-        except Exception as e:
-            ip = '127.0.0.1'
-        return ip
-
-if __name__ == "__main__":
-    root = tk.Tk()
-    server = ChatServer(root)
-    root.protocol("WM_DELETE_WINDOW", server.stop_server)
-    root.mainloop()
+import socket
+import threading
+import time
+import tkinter as tk
+import sys
+from chat_view import MessageView, UiQueue
+from connection import ClientConnection, configure_keepalive
+from discovery import DiscoveryResponder, local_addresses
+from send_queue import DROP_OLDEST, SEND_QUEUE_SIZE
+from protocol import FrameDecoder, RECV_SIZE
+
+BROADCAST_PORT = 5555
+BUFFER_SIZE = RECV_SIZE
+OVERFLOW_POLICY = DROP_OLDEST  # or COALESCE / DISCONNECT, see send_queue.py
+FLUSH_WINDOW = 0.0  # e.g. send_queue.FLUSH_WINDOW to batch bursts into fewer writes
+CIPHER = "aes-gcm"  # or "chacha20", see session_crypto.ALGORITHM_NAMES
+PROFILE_FILE = "server_profile.txt"
+
+class ChatServer:
+    def __init__(self, master):
+        self.master = master
+        self.master.title("Chat Server 1.0.2")  # Version number added here
+
+        self.server = None
+        self.is_running = False
+        # Session keys, client registry and broadcast live in the hub, shared with async_server.py
+        self.ui = UiQueue(master)  # network threads hand UI work to the Tk loop through this
+        self.hub = None  # created by load_hub() once the window is up
+        self.clients = None
+        self.metrics_server = None  # http://127.0.0.1:METRICS_PORT/metrics while running
+        self.discovery = None  # answers clients looking for a server on the LAN
+
+        self.start_button = tk.Button(master, text="Start Server", command=self.start_server, state=tk.DISABLED)
+        self.start_button.pack(pady=5)
+        
+        self.stop_button = tk.Button(master, text="Stop Server", command=self.stop_server, state=tk.DISABLED)
+        self.stop_button.pack(pady=5)
+
+        self.profile_button = tk.Button(master, text="Start Profiler", command=self.toggle_profiler, state=tk.DISABLED)
+        self.profile_button.pack(pady=5)
+
+        self.messages_frame = tk.Frame(master)
+        scrollbar = tk.Scrollbar(self.messages_frame)
+        self.msg_list = MessageView(self.messages_frame, ui=self.ui, height=15, width=50, yscrollcommand=scrollbar.set, wrap=tk.WORD)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.msg_list.pack(side=tk.LEFT, fill=tk.BOTH)
+        self.msg_list.pack()
+        self.messages_frame.pack(pady=10)
+
+        self.local_ip_label = tk.Label(master, text="Server IP: Not running")
+        self.local_ip_label.pack(pady=5)
+
+        self.stats_label = tk.Label(master, text="Loading...", font=("Arial", 9))
+        self.stats_label.pack(pady=5)
+
+        # Adding version label
+        self.version_label = tk.Label(master, text="Version 1.0.2", font=("Arial", 10))
+        self.version_label.pack(side=tk.TOP, anchor="ne", padx=10, pady=5)
+        self.master.bind("<Map>", self.on_map)
+
+    def on_map(self, event):
+        if event.widget is self.master:
+            self.master.unbind("<Map>")
+            self.master.after_idle(self.load_hub)  # once the window has been drawn
+
+    def load_hub(self):
+        # The hub pulls in cryptography, sqlite3 and http.server, the bulk
+        # of our import time, so it is only imported after the window is up.
+        from history import HistoryStore, HISTORY_FILE, REPLAY_COUNT
+        from hub import ChatHub
+        from session_crypto import ALGORITHM_NAMES
+        self.hub = ChatHub(self.display, ALGORITHM_NAMES[CIPHER], SEND_QUEUE_SIZE, HistoryStore(HISTORY_FILE),
+                           REPLAY_COUNT)
+        self.clients = self.hub.clients
+        self.start_button.config(state=tk.NORMAL)
+        self.update_stats()
+
+    def display(self, message):
+        # Called from accept/client threads; Tk itself is only touched by the UI pump.
+        self.ui.post(self.msg_list.append, message)
+
+    def broadcast(self, message, _client=None):
+        self.hub.broadcast(message, _client)
+
+    def update_stats(self):
+        self.stats_label.config(text=self.hub.broadcast_stats.summary() + "\n" + self.hub.queue_summary())
+        self.master.after(1000, self.update_stats)
+
+    def handle_client(self, client):
+        decoder = FrameDecoder()
+        while self.is_running:
+            try:
+                frames = decoder.recv_from(client.sock, BUFFER_SIZE)
+                if frames is None:
+                    break
+                for msg_type, payload in frames:
+                    self.hub.handle_frame(client, msg_type, payload)
+            except:
+                self.hub.remove_client(client, flush=False)
+                return
+        self.hub.remove_client(client)
+
+    def start_server(self):
+        if not self.is_running:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(("", BROADCAST_PORT))  # every interface; a VPN or VM adapter may come first
+            self.server.listen()
+            self.is_running = True
+            self.start_button.config(state=tk.DISABLED)
+            self.stop_button.config(state=tk.NORMAL)
+            self.local_ip_label.config(text=f"Server IP: {', '.join(self.get_ip_addresses())}")
+            threading.Thread(target=self.accept_clients).start()
+            threading.Thread(target=self.reap_clients, daemon=True).start()
+            self.display("Server started...")
+            from metrics import MetricsServer, METRICS_PORT
+            try:
+                self.metrics_server = MetricsServer(self.hub.metrics, self.hub.stats, port=METRICS_PORT).start()
+                self.profile_button.config(state=tk.NORMAL)
+                self.display(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+            except OSError as e:
+                self.display(f"Metrics endpoint unavailable: {e}")
+            try:
+                self.discovery = DiscoveryResponder(BROADCAST_PORT).start()
+            except OSError as e:
+                self.display(f"Discovery unavailable: {e}")
+
+    def toggle_profiler(self):
+        profiler = self.metrics_server.profiler
+        if not profiler.running:
+            profiler.start()
+            self.profile_button.config(text="Stop Profiler")
+            return
+        profiler.stop()
+        with open(PROFILE_FILE, "w", encoding="utf-8") as f:
+            f.write(profiler.report(limit=200))
+        self.profile_button.config(text="Start Profiler")
+        self.display(f"Profile written to {PROFILE_FILE}")
+
+    def accept_clients(self):
+        self.server.settimeout(1)  # Set a timeout for accept
+        while self.is_running:
+            try:
+                sock, addr = self.server.accept()
+                configure_keepalive(sock)
+                self.display(f"Connected with {addr}")
+                client = ClientConnection(self.clients.next_id(), sock, addr, SEND_QUEUE_SIZE, OVERFLOW_POLICY,
+                                          FLUSH_WINDOW)
+                self.hub.open(client)  # Start the key exchange
+                client.start()
+                thread = threading.Thread(target=self.handle_client, args=(client,))
+                thread.start()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+    def reap_clients(self):
+        # One thread for all connections: closes the ones gone silent.
+        from hub import REAP_TICK
+        while self.is_running:
+            time.sleep(REAP_TICK)
+            self.hub.reap_idle()
+
+    def stop_server(self):
+        if self.is_running:
+            self.is_running = False
+            self.hub.shutdown()  # Notify clients about server stop and close them
+            if self.server:
+                self.server.close()
+            if self.metrics_server:
+                self.metrics_server.stop()
+                self.metrics_server = None
+            if self.discovery:
+                self.discovery.stop()
+                self.discovery = None
+            self.profile_button.config(state=tk.DISABLED, text="Start Profiler")
+            self.start_button.config(state=tk.NORMAL)
+            self.stop_button.config(state=tk.DISABLED)
+            self.local_ip_label.config(text="Server IP: Not running")
+            self.display("Server stopped...")
+            self.master.quit()
+
+    def get_ip_addresses(self):
+        # Local interface lookup only; works with no network at all. For
+        # display: which one the students need depends on their network.
+        addresses = local_addresses()
+        return [ip for ip in addresses if not ip.startswith("127.")] or addresses
+
+if __name__ == "__main__":
+    if "--headless" in sys.argv:
+        # Tk-free asyncio core, e.g. for running as a daemon on a Linux box
+        import async_server
+        sys.exit(async_server.main([arg for arg in sys.argv[1:] if arg != "--headless"]))
+    root = tk.Tk()
+    server = ChatServer(root)
+    root.protocol("WM_DELETE_WINDOW", server.stop_server)
+    root.mainloop()
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TimerWheel:
+    # Hashed timing wheel: `slots` buckets of `tick` seconds each. A timer
+    # goes into the bucket for the tick it expires on; advance() only looks
+    # at the buckets whose ticks have passed, so the cost per tick is the
+    # number of timers in those buckets, not the number of timers overall.
+    # Timers further out than one revolution stay in their bucket and are
+    # skipped until their round comes up. There is no cancel: callers check
+    # whether an expired item still matters and schedule it again if needed
+    # ("lazy rescheduling"), which keeps the hot path free of timer updates.
+    def __init__(self, tick=1.0, slots=128, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._slots = [[] for _ in range(slots)]
+        self._lock = threading.Lock()
+        self._current = int(clock() / tick)  # last tick already processed
+        self.count = 0
+
+    def schedule(self, item, delay):
+        due = int((self.clock() + max(delay, 0)) / self.tick) + 1
+        with self._lock:
+            due = max(due, self._current + 1)
+            self._slots[due % len(self._slots)].append((due, item))
+            self.count += 1
+
+    def advance(self):
+        # Returns the items whose timers have expired since the last call.
+        expired = []
+        now = int(self.clock() / self.tick)
+        with self._lock:
+            # After a long stall one revolution already visits every bucket.
+            for tick in range(self._current + 1, min(now, self._current + len(self._slots)) + 1):
+                slot = self._slots[tick % len(self._slots)]
+                if not slot:
+                    continue
+                keep = [entry for entry in slot if entry[0] > now]
+                if len(keep) != len(slot):
+                    expired.extend(item for due, item in slot if due <= now)
+                    self._slots[tick % len(self._slots)] = keep
+            self._current = max(self._current, now)
+            self.count -= len(expired)
+        return expired
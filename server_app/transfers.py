@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from protocol import HEADER_SIZE, CHUNK, CHUNK_SIZE, TRANSFER_WINDOW, MAX_FILE_SIZE, blob_hash
+from session_crypto import InvalidTag, NONCE_SIZE, TAG_SIZE
+
+SPOOL_BYTES = 2 * 1024 * 1024 * 1024  # all stored files together
+MAX_UPLOADS = 4     # unfinished uploads per connection
+MAX_DOWNLOADS = 8   # files streamed to one connection at once
+OWNER_STALE = 30    # seconds an unfinished upload may sit still before another uploader can take it over
+# A full chunk as stored in the spool: a complete MSG_FILE_CHUNK frame.
+FRAME_SPAN = HEADER_SIZE + CHUNK.size + NONCE_SIZE + CHUNK_SIZE + TAG_SIZE
+
+
+class TransferError(Exception):
+    pass
+
+
+def spool_offset(offset):
+    # Where the frame holding file offset `offset` starts in the spool file.
+    return offset // CHUNK_SIZE * FRAME_SPAN
+
+
+class Upload:
+    # One file being received. Chunks must come in order; each one is
+    # appended as the finished frame downloaders will get and hashed, and
+    # the file is renamed into place when the last one is written and the
+    # hash matches the transfer id, so nobody can put other content under
+    # the id of a popular file.
+    def __init__(self, transfer_id, size, offset, file=None, part=None, path=None, digest=None, owner=None,
+                 token=None):
+        self.id = transfer_id
+        self.size = size
+        self.offset = offset  # next chunk expected
+        self.file = file
+        self.part = part
+        self.path = path
+        self.digest = digest
+        self.owner = owner  # lock file holding the uploader's token
+        self.token = token
+        self.granted = offset  # the limit in our last ACK; nothing past it is accepted
+
+    @property
+    def done(self):
+        return self.offset >= self.size
+
+    @property
+    def limit(self):
+        return min(self.size, self.offset + TRANSFER_WINDOW)
+
+    def grant(self):
+        # The limit for the next ACK, remembered so chunks past it are refused.
+        self.granted = self.limit
+        return self.granted
+
+    def chunk_size(self):
+        return min(CHUNK_SIZE, self.size - self.offset)
+
+    def append(self, frame, chunk):
+        # Raises TransferError if the finished file is not what its id says.
+        self.file.write(frame)
+        self.digest.update(chunk)
+        self.offset += len(chunk)
+        if not self.done:
+            return
+        self.file.close()
+        try:
+            if self.digest.digest() != self.id:
+                os.remove(self.part)
+                raise TransferError("The file does not match its hash.")
+            os.replace(self.part, self.path)  # now visible to downloaders
+        finally:
+            self.release()
+
+    def release(self):
+        try:
+            with open(self.owner, "rb") as f:
+                if f.read() != self.token:
+                    return  # taken over by someone else
+            os.remove(self.owner)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+            self.release()
+
+
+class Download:
+    # One file streamed to one connection straight from the spool, a whole
+    # frame at a time and never past the credit the downloader gave us. The
+    # connection's writer picks these up whenever its send queue is empty.
+    def __init__(self, transfer_id, path, offset, limit):
+        self.id = transfer_id
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size  # bytes in the spool, not in the file
+        self.position = min(spool_offset(offset), self.size)
+        self.end = self.position
+        self.credit(limit)
+
+    @property
+    def done(self):
+        return self.position >= self.size
+
+    def credit(self, limit):
+        # Every chunk starting before `limit` may be sent.
+        self.end = max(self.end, min(self.size, spool_offset(limit + CHUNK_SIZE - 1)))
+
+    def next_span(self):
+        # (spool offset, length) of the next frame, or None while out of credit.
+        if self.position >= self.end:
+            return None
+        return self.position, min(FRAME_SPAN, self.end - self.position)
+
+    def sent(self, nbytes):
+        self.position += nbytes
+
+    def close(self):
+        self.file.close()
+
+
+class FileSpool:
+    # Uploaded files, one per transfer id, in a directory every process of
+    # a cluster can see. A file is stored once, already framed and encrypted
+    # under the broadcast key, so serving it is a plain copy from disk to
+    # socket (os.sendfile where there is one), however many download it and
+    # without holding it in memory. Files are named by transfer id, which
+    # is their content hash: one copy per content, however often it is
+    # shared. Unfinished uploads keep a ".part" suffix; a reconnecting
+    # uploader continues after the last whole frame.
+    # The spool only lives as long as the broadcast key: an owned temporary
+    # directory is removed by close().
+    def __init__(self, directory=None, max_bytes=SPOOL_BYTES):
+        self.directory = directory
+        self.owned = directory is None
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, transfer_id, suffix=""):
+        if self.directory is None:
+            with self._lock:
+                if self.directory is None:  # created on first use
+                    self.directory = tempfile.mkdtemp(prefix="lesnet-files-")
+        return os.path.join(self.directory, transfer_id.hex() + suffix)
+
+    def used(self):
+        with os.scandir(self.directory) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+    def open_upload(self, transfer_id, size, token, cipher):
+        # An Upload positioned where the last attempt stopped, or already
+        # done if the file is here. `cipher` is the broadcast key the spool
+        # is encrypted under, to hash what is already stored when resuming.
+        # Raises TransferError to refuse.
+        if not 0 < size <= MAX_FILE_SIZE:
+            raise TransferError(f"Files can be at most {MAX_FILE_SIZE // (1024 * 1024)} MiB.")
+        path = self.path(transfer_id)
+        if os.path.exists(path):
+            return Upload(transfer_id, size, size)
+        part = self.path(transfer_id, ".part")
+        if self.used() + spool_offset(size + CHUNK_SIZE) > self.max_bytes:
+            raise TransferError("The server has no room for more files right now.")
+        owner = self.path(transfer_id, ".owner")
+        self.claim(owner, part, token)
+        file = open(part, "a+b")
+        chunks = os.fstat(file.fileno()).st_size // FRAME_SPAN
+        if chunks * CHUNK_SIZE >= size:
+            chunks = 0  # left over from a different file
+        digest = blob_hash()
+        file.seek(0)
+        try:
+            for _ in range(chunks):
+                frame = file.read(FRAME_SPAN)
+                header = frame[HEADER_SIZE:HEADER_SIZE + CHUNK.size]
+                digest.update(cipher.decrypt(frame[HEADER_SIZE + CHUNK.size:], header))
+        except InvalidTag:
+            chunks, digest = 0, blob_hash()
+        file.truncate(chunks * FRAME_SPAN)  # drop a frame torn by the disconnect
+        return Upload(transfer_id, size, chunks * CHUNK_SIZE, file, part, path, digest, owner, token)
+
+    def claim(self, owner, part, token):
+        # One uploader per file at a time. The same uploader coming back
+        # after a reconnect takes its upload over, and so does anyone once
+        # the upload has sat still for OWNER_STALE.
+        try:
+            fd = os.open(owner, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            with open(owner, "rb") as f:
+                current = f.read()
+            try:
+                idle = time.time() - os.path.getmtime(part)
+            except OSError:
+                idle = OWNER_STALE
+            if current != token and idle < OWNER_STALE:
+                raise TransferError("Someone is sending the same file right now; try again in a moment.")
+            fd = os.open(owner, os.O_WRONLY | os.O_TRUNC)
+        with os.fdopen(fd, "wb") as f:
+            f.write(token)
+
+    def open_download(self, transfer_id, offset, limit):
+        # None if there is no such file (yet).
+        try:
+            return Download(transfer_id, self.path(transfer_id), offset, limit)
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        if self.owned and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)